@@ -1,27 +1,233 @@
-import httpx
-from cyclopts import App
+import time
+
+# Taken before the remaining imports so that startup metrics include them
+PROCESS_START = time.perf_counter()
+
+# Heavy dependencies (httpx, rich) are imported inside the functions that use
+# them so that commands which never touch the network or render Markdown
+# don't pay for importing them. See `p90 startup-profile`.
+from cyclopts import App, Parameter
+import codecs
+import collections
+import contextvars
+import functools
+import hashlib
+import importlib.util
 import json
+import math
+import mmap
 import os
 import subprocess
+import sys
 import tempfile
+import threading
 from pathlib import Path
-from typing import Dict, Any, Optional
-from dataclasses import dataclass
+from typing import (
+    TYPE_CHECKING,
+    Annotated,
+    Dict,
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+)
+from dataclasses import asdict, dataclass, replace
+import random
 import re
+import shutil
+import signal
+import socket
+import struct
 from datetime import datetime
-from rich.console import Console
-from rich.table import Table
-from rich.markdown import Markdown
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: rate limits can't be shared across processes
+    fcntl = None
+
+if TYPE_CHECKING:
+    import asyncio
+    import sqlite3
+
+    import httpx
+    from rich.console import Console
 
 app = App()
-console = Console()
 
 # Constants
 USER_CONFIG_DIR = Path.home() / ".p90"
 CONFIG_PATH = USER_CONFIG_DIR / "config.json"
 SYSTEM_PROMPT_PATH = USER_CONFIG_DIR / "system_prompt.md"
 SCRIPTS_DIR = USER_CONFIG_DIR / "scripts"
+SCRIPT_CATALOG_PATH = USER_CONFIG_DIR / "scripts.db"
+RESPONSE_CACHE_DIR = USER_CONFIG_DIR / "cache" / "responses"
+SIMILAR_CACHE_DIR = USER_CONFIG_DIR / "cache" / "similar"
+SIMILAR_INDEX_PATH = SIMILAR_CACHE_DIR / "index.bin"
+DIR_INDEX_DIR = USER_CONFIG_DIR / "dir_index"
+ENVIRONMENT_PROBE_PATH = USER_CONFIG_DIR / "environment.json"
+DAEMON_SOCKET_PATH = USER_CONFIG_DIR / "daemon.sock"
+CONVERSATIONS_DIR = USER_CONFIG_DIR / "conversations"
+RATE_LIMIT_STATE_PATH = USER_CONFIG_DIR / "rate_limit.json"
+RATE_LIMIT_LOCK_PATH = USER_CONFIG_DIR / "rate_limit.lock"
+METRICS_DIR = USER_CONFIG_DIR / "metrics"
+REQUEST_METRICS_PATH = METRICS_DIR / "requests.jsonl"
+RUN_METRICS_PATH = METRICS_DIR / "runs.jsonl"
+SKETCHES_PATH = METRICS_DIR / "sketches.json"
+SKETCHES_LOCK_PATH = METRICS_DIR / "sketches.lock"
 OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+API_KEY_MISSING_MESSAGE = "OpenRouter API key not configured. Please run 'p90 config' to set your openrouter_api_key."
+
+# Config keys consumed by p90 itself and never forwarded to the model
+CLIENT_CONFIG_KEYS = (
+    "openrouter_api_key",
+    "stream",
+    "startup_budget_ms",
+    "cache_ttl_seconds",
+    "cache_max_mb",
+    "similar_cache",
+    "similar_cache_threshold",
+    "similar_cache_max_entries",
+    "repl_history_turns",
+    "history_token_budget",
+    "race_models",
+    "hedge",
+    "hedge_model",
+    "max_retries",
+    "fallback_models",
+    "rate_limit_rpm",
+    "rate_limit_tpm",
+    "rate_limit_shared",
+    "timeouts",
+    "prompt_variables",
+    "prompt_variable_budget_ms",
+)
+
+# Response cache defaults; a TTL of 0 disables the cache
+CACHE_TTL_SECONDS = 24 * 60 * 60
+CACHE_MAX_MB = 50
+
+# Near-duplicate cache tier: MinHash signatures over character n-grams of the
+# normalized query, stored as fixed-size records in a ring buffer file
+SIMILAR_CACHE_THRESHOLD = 0.8
+SIMILAR_CACHE_MAX_ENTRIES = 5000
+MINHASH_PERMUTATIONS = 64
+SHINGLE_SIZE = 3
+SIMILAR_INDEX_HEADER = struct.Struct("<Q")
+SIMILAR_INDEX_RECORD = struct.Struct(f"<8s{MINHASH_PERMUTATIONS}I")
+STOP_WORDS = frozenset(
+    "a an and are can do does for from how i in is it me my of on or please "
+    "show tell that the this to what with you".split()
+)
+
+# Prompt variables left out of cache keys because they change on every call
+VOLATILE_PROMPT_VARIABLES = ("DATE",)
+
+# `${{NAME}}` placeholders in the system prompt. Only the variables a prompt
+# references are evaluated; slow ones run in parallel and are reported as
+# unavailable once the budget is spent rather than delaying the request.
+PROMPT_VARIABLE_PATTERN = re.compile(r"\$\{\{([A-Z0-9_]+)\}\}")
+PROMPT_VARIABLE_BUDGET_MS = 500
+PROMPT_COMMAND_TIMEOUT = 5
+DIR_LISTING_MAX_ENTRIES = 50
+
+# ${{DIR_SUMMARY}}: per-directory index of the working tree that is refreshed
+# by stat'ing each directory and rescanning only those whose mtime changed
+DIR_INDEX_MAX_DIRS = 20000
+DIR_INDEX_SKIP = frozenset({".git", ".hg", ".svn"})
+DIR_SUMMARY_TREE_DEPTH = 2
+DIR_SUMMARY_TREE_WIDTH = 10
+DIR_SUMMARY_EXTENSIONS = 15
+DIR_SUMMARY_LARGEST = 10
+
+# Orderings offered by `p90 scripts --sort`
+SCRIPT_SORT_ORDERS = {
+    "name": "name",
+    "created": "created DESC",
+    "runs": "run_count DESC, name",
+    "last-run": "last_run IS NULL, last_run DESC",
+    "size": "size DESC",
+}
+
+# Tools probed for ${{TOOLS}} so generated commands can use the fastest ones
+# installed. The probe is cached per host until PATH or its directories change.
+PROBED_TOOLS = (
+    "rg",
+    "fd",
+    "fdfind",
+    "jq",
+    "parallel",
+    "fzf",
+    "git",
+    "curl",
+    "uv",
+    "docker",
+)
+TOOL_VERSION_TIMEOUT = 2
+
+# Keep-alive tuning for the shared HTTP client
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 10
+HTTP_KEEPALIVE_EXPIRY = 120
+
+# Default import-time budget for `p90 startup-profile`
+STARTUP_BUDGET_MS = 150
+
+# Default number of in-flight requests for `p90 batch`
+BATCH_CONCURRENCY = 8
+
+# Bytes read from a command's stdout/stderr per chunk while streaming output
+EXECUTE_CHUNK_SIZE = 4096
+
+# Number of earlier question/answer pairs `p90 repl` sends with each prompt
+REPL_HISTORY_TURNS = 10
+
+# Token budget for the conversation history sent with each prompt. Older turns
+# beyond it are dropped and summarized by their questions.
+HISTORY_TOKEN_BUDGET = 4000
+HISTORY_SUMMARY_QUESTION_CHARS = 120
+
+# Metrics logs rotate past this size, keeping a few old files. Percentiles
+# come from persisted quantile sketches, so they cover all history regardless.
+METRICS_MAX_BYTES = 1024 * 1024
+METRICS_BACKUPS = 3
+SKETCH_RELATIVE_ACCURACY = 0.01
+
+# Hedged requests fire a duplicate once the primary is slower than this
+# quantile of the model's recorded time to first token. Until enough history
+# exists the default delay is used.
+HEDGE_QUANTILE = 0.9
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY_MS = 3000
+
+# Retry policy per error class: how often to retry on the same model, the base
+# of the exponential backoff, and whether to move on to fallback models
+RETRY_POLICIES = {
+    "rate_limit": {"retries": 4, "base_delay": 1.0, "fallback": True},
+    "server": {"retries": 2, "base_delay": 0.5, "fallback": True},
+    "network": {"retries": 2, "base_delay": 0.25, "fallback": True},
+    "client": {"retries": 0, "base_delay": 0.0, "fallback": True},
+    "auth": {"retries": 0, "base_delay": 0.0, "fallback": False},
+}
+RETRY_MAX_DELAY = 30.0
+
+# Models that only cache prompts at explicit cache_control breakpoints, and
+# the smallest prefix worth marking. Anthropic won't cache fewer than 1024
+# tokens (more for Haiku), so shorter prefixes are sent without a breakpoint.
+PROMPT_CACHE_CONTROL_PREFIXES = ("anthropic/", "google/gemini")
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+# Request timeouts in seconds. `first_byte` bounds the wait for the first
+# streamed token, `idle` the gap between stream chunks after it (keep-alive
+# comments count as progress) and `total` the whole request.
+DEFAULT_TIMEOUTS = {"connect": 10.0, "first_byte": 60.0, "idle": 30.0, "total": 600.0}
+
+# Minimum seconds between live Markdown re-renders while streaming
+STREAM_RENDER_INTERVAL = 0.05
 
 
 @dataclass
@@ -32,274 +238,2742 @@ class ParsedResponse:
     script_body: str = ""
 
 
-# ===== COMMANDS =====
+@dataclass
+class AppConfig:
+    api_key: str
+    model_config: Dict[str, Any]
+    client_config: Dict[str, Any]
+    system_prompt: str
+
+
+@dataclass
+class RequestMetrics:
+    model: str
+    timestamp: float
+    request_bytes: int = 0
+    estimated_prompt_tokens: int = 0
+    prompt_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    connect_ms: Optional[float] = None  # includes DNS resolution
+    tls_ms: Optional[float] = None
+    ttfb_ms: Optional[float] = None
+    first_token_ms: Optional[float] = None
+    total_ms: Optional[float] = None
+    error: Optional[str] = None
+    hedged: bool = False  # sent as part of a hedged request
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """A system prompt parsed into literal text and variable names."""
+
+    # Alternating literal text and variable names, starting and ending with text
+    parts: Tuple[str, ...]
+
+    @property
+    def variables(self) -> List[str]:
+        return list(dict.fromkeys(self.parts[1::2]))
+
+    def render(self, values: Dict[str, str]) -> str:
+        """Fill in the variables, leaving placeholders without a value as they are."""
+        return "".join(
+            part if i % 2 == 0 else values.get(part, "${{" + part + "}}")
+            for i, part in enumerate(self.parts)
+        )
+
+
+class QuantileSketch:
+    """Streaming quantile sketch with bounded relative error (DDSketch style).
+
+    Values are counted in logarithmic buckets, so any quantile is accurate to
+    within SKETCH_RELATIVE_ACCURACY and the size grows only with the range of
+    values seen, not their number.
+    """
+
+    def __init__(self, buckets: Optional[Dict[int, int]] = None):
+        self.gamma = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+        self.buckets: Dict[int, int] = buckets or {}
+
+    @property
+    def count(self) -> int:
+        return sum(self.buckets.values())
+
+    def add(self, value: float):
+        index = math.ceil(math.log(max(value, 1e-3), self.gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.buckets:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * self.gamma**index / (self.gamma + 1)
+        return None
+
+    def to_dict(self) -> Dict[str, int]:
+        return {str(index): count for index, count in self.buckets.items()}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, int]) -> "QuantileSketch":
+        return cls({int(index): count for index, count in data.items()})
+
+
+class RateLimiter:
+    """Token-bucket limiter for requests per minute and tokens per minute.
+
+    Both buckets refill continuously and start full. `acquire` waits until a
+    request and its estimated tokens fit. When `shared` is set, bucket state
+    lives in a file under `~/.p90/` guarded by a lock file, so all p90
+    processes draw from the same budget.
+    """
+
+    def __init__(self, rpm: float, tpm: float, shared: bool = False):
+        import asyncio
+
+        self.rpm = rpm
+        self.tpm = tpm
+        self.shared = shared and fcntl is not None
+        self.state = {"requests": rpm, "tokens": tpm, "updated": time.time()}
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        import asyncio
+
+        if not self.rpm and not self.tpm:
+            return
+
+        # A request larger than the whole bucket would otherwise wait forever
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        async with self.lock:
+            while True:
+                wait = self._take_shared(tokens) if self.shared else self._take(tokens)
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+
+    def _take(self, tokens: int) -> float:
+        """Take from the buckets if possible; otherwise return seconds to wait."""
+        now = time.time()
+        elapsed = max(0.0, now - self.state["updated"])
+        self.state["updated"] = now
+
+        waits = [0.0]
+        for key, limit, amount in (
+            ("requests", self.rpm, 1),
+            ("tokens", self.tpm, tokens),
+        ):
+            if not limit:
+                continue
+            level = min(limit, self.state[key] + elapsed * limit / 60)
+            self.state[key] = level
+            if level < amount:
+                waits.append((amount - level) * 60 / limit)
+
+        wait = max(waits)
+        if wait <= 0:
+            self.state["requests"] -= 1 if self.rpm else 0
+            self.state["tokens"] -= tokens
+        return wait
+
+    def _take_shared(self, tokens: int) -> float:
+        USER_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+        with open(RATE_LIMIT_LOCK_PATH, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    self.state = load_json(RATE_LIMIT_STATE_PATH)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    pass
+                wait = self._take(tokens)
+                save_json(RATE_LIMIT_STATE_PATH, self.state)
+                return wait
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# ===== COMMANDS =====
+
+
+@app.default
+def default_action(
+    *args: str,
+    no_cache: Annotated[bool, Parameter(negative="")] = False,
+    tee: Optional[Path] = None,
+):
+    """Main command handler.
+
+    Parameters
+    ----------
+    no_cache: bool
+        Skip the local response cache and always query the model.
+    tee: Optional[Path]
+        Also append the output of executed commands and scripts to this file.
+    """
+    run_async(run_default_action(args, no_cache, tee))
+
+
+@app.command
+def config():
+    """Opens the model and sampler config in the default editor."""
+    ensure_config_exists()
+    subprocess.run([get_editor(), str(CONFIG_PATH)])
+
+
+@app.command
+def reset():
+    """Resets the config and system prompt back to the defaults."""
+    # Preserve API key if it exists
+    api_key = None
+    if CONFIG_PATH.exists():
+        try:
+            api_key = load_json(CONFIG_PATH).get("openrouter_api_key")
+        except:
+            pass
+
+    # Copy defaults
+    default_config = json.loads(app_config)
+    if api_key:
+        default_config["openrouter_api_key"] = api_key
+
+    ensure_config_exists()
+    save_json(CONFIG_PATH, default_config)
+
+    # Copy system prompt
+    with open(SYSTEM_PROMPT_PATH, "w") as f:
+        f.write(app_system_prompt)
+
+    print("Config and system prompt reset to defaults (API key preserved)")
+
+
+@app.command
+def scripts(
+    sort: Literal["name", "created", "runs", "last-run", "size"] = "name",
+    search: Optional[str] = None,
+):
+    """Lists all available scripts in the `~/.p90/scripts/` directory.
+
+    Parameters
+    ----------
+    sort: Literal["name", "created", "runs", "last-run", "size"]
+        Order of the listing.
+    search: Optional[str]
+        Only list scripts whose name or summary contains this text.
+    """
+    catalog = get_script_catalog()
+    sync_script_catalog(catalog)
+    if search:
+        # Summaries are matched, so make sure edited scripts' are current
+        refresh_script_catalog(catalog)
+
+    query = "SELECT * FROM scripts"
+    params = []
+    if search:
+        query += " WHERE name LIKE ? OR summary LIKE ?"
+        params = [f"%{search}%"] * 2
+    rows = catalog.execute(
+        f"{query} ORDER BY {SCRIPT_SORT_ORDERS[sort]}", params
+    ).fetchall()
+
+    if not rows:
+        get_console().print("[yellow]No scripts found[/yellow]")
+        return
+
+    from rich.table import Table
+
+    table = Table(title="Available Scripts")
+    table.add_column("Name", style="cyan")
+    table.add_column("Summary")
+    table.add_column("Size", style="magenta")
+    table.add_column("Created", style="green")
+    table.add_column("Runs", justify="right")
+    table.add_column("Last run", style="green")
+    table.add_column("Last exit", justify="right")
+
+    for row in rows:
+        table.add_row(
+            row["name"],
+            row["summary"] or "",
+            f"{row['size']} bytes",
+            datetime.fromtimestamp(row["created"]).strftime("%Y-%m-%d %H:%M"),
+            str(row["run_count"]),
+            datetime.fromtimestamp(row["last_run"]).strftime("%Y-%m-%d %H:%M")
+            if row["last_run"]
+            else "-",
+            "-" if row["last_exit_status"] is None else str(row["last_exit_status"]),
+        )
+
+    get_console().print(table)
+
+
+@app.command
+def delete(script_name: str):
+    """Deletes the script with the given name from the `~/.p90/scripts/` directory."""
+    if not script_name.endswith(".py"):
+        script_name += ".py"
+
+    script_path = SCRIPTS_DIR / script_name
+    remove_script(script_name)
+
+    if not script_path.exists():
+        print(f"Script '{script_name}' does not exist in ~/.p90/scripts/")
+        return
+
+    script_path.unlink()
+    print(f"Successfully deleted script '{script_name}'")
+
+
+@app.command(name="startup-profile")
+def startup_profile(top: int = 15, budget_ms: Optional[int] = None):
+    """Reports module import time at startup and checks it against a budget.
+
+    Parameters
+    ----------
+    top: int
+        Number of slowest imports to list.
+    budget_ms: Optional[int]
+        Import time budget in milliseconds. Defaults to `startup_budget_ms` in the config.
+    """
+    from rich.table import Table
+
+    if budget_ms is None:
+        budget_ms = load_config().client_config.get(
+            "startup_budget_ms", STARTUP_BUDGET_MS
+        )
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import p90.__main__"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        get_console().print(f"[red]{result.stderr}[/red]")
+        raise SystemExit(1)
+
+    imports = parse_importtime(result.stderr)
+    # Top-level imports (no indentation) add up to the total startup cost
+    total_us = sum(us for name, _, us in imports if not name.startswith(" "))
+
+    table = Table(title="Slowest Imports")
+    table.add_column("Module", style="cyan")
+    table.add_column("Self (ms)", style="magenta", justify="right")
+    table.add_column("Cumulative (ms)", style="green", justify="right")
+
+    for name, self_us, cumulative_us in sorted(imports, key=lambda i: -i[2])[:top]:
+        table.add_row(
+            name.strip(), f"{self_us / 1000:.1f}", f"{cumulative_us / 1000:.1f}"
+        )
+
+    get_console().print(table)
+
+    total_ms = total_us / 1000
+    if total_ms > budget_ms:
+        get_console().print(
+            f"[red]Import time {total_ms:.1f} ms exceeds budget of {budget_ms} ms[/red]"
+        )
+        raise SystemExit(1)
+
+    get_console().print(
+        f"[green]Import time {total_ms:.1f} ms is within budget of {budget_ms} ms[/green]"
+    )
+
+
+@app.command
+def repl(session: Optional[str] = None, tee: Optional[Path] = None):
+    """Starts an interactive session that remembers earlier questions and answers.
+
+    The process, config and HTTP connection stay warm between prompts. Responses
+    depend on the conversation so the response cache is not used.
+
+    Parameters
+    ----------
+    session: Optional[str]
+        Name of a conversation to resume and persist in `~/.p90/conversations/`.
+    tee: Optional[Path]
+        Also append the output of executed commands and scripts to this file.
+    """
+    run_async(run_repl(session, tee))
+
+
+@app.command
+def daemon():
+    """Runs a background server that answers prompts for other p90 invocations.
+
+    While it runs, `p90 "..."` forwards the prompt over a Unix socket in
+    `~/.p90/` and reuses the daemon's warm connection, config and caches. Commands
+    and scripts still run in the calling terminal.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        print("The p90 daemon requires Unix domain sockets")
+        raise SystemExit(1)
+
+    try:
+        run_async(serve_daemon())
+    except KeyboardInterrupt:
+        print("p90 daemon stopped")
+
+
+@app.command
+def stats(last: int = 20):
+    """Shows latency percentiles and the token counts, payload sizes and latency of recent API requests.
+
+    Parameters
+    ----------
+    last: int
+        Number of most recent requests to list.
+    """
+    from rich.table import Table
+
+    sketches = load_sketches()
+    for prefix, title in (
+        ("model:", "Run Latency by Model"),
+        ("type:", "Run Latency by Response Type"),
+        ("cached:", "Cached Run Latency by Response Type"),
+        ("request:", "Request Latency by Model"),
+    ):
+        groups = {
+            group[len(prefix) :]: metrics
+            for group, metrics in sketches.items()
+            if group.startswith(prefix)
+        }
+        if groups:
+            get_console().print(percentile_table(title, groups))
+
+    requests = load_request_metrics()
+    if not requests:
+        get_console().print("[yellow]No requests recorded yet[/yellow]")
+        return
+
+    def ms(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value:.0f}"
+
+    table = Table(title="Recent Requests")
+    table.add_column("Time", style="green")
+    table.add_column("Model", style="cyan")
+    table.add_column("Prompt tok", justify="right")
+    table.add_column("Cached tok", justify="right")
+    table.add_column("Completion tok", justify="right")
+    table.add_column("Bytes", justify="right")
+    table.add_column("Connect ms", justify="right")
+    table.add_column("TLS ms", justify="right")
+    table.add_column("TTFB ms", justify="right")
+    table.add_column("First token ms", justify="right")
+    table.add_column("Total ms", justify="right", style="magenta")
+
+    for request in requests[-last:]:
+        prompt_tokens = request.get("prompt_tokens")
+        table.add_row(
+            datetime.fromtimestamp(request["timestamp"]).strftime("%Y-%m-%d %H:%M"),
+            request["model"]
+            if not request.get("error")
+            else f"{request['model']} [red](error)[/red]",
+            str(prompt_tokens)
+            if prompt_tokens is not None
+            else f"~{request['estimated_prompt_tokens']}",
+            str(request.get("cached_tokens") or "-"),
+            str(request.get("completion_tokens") or "-"),
+            str(request["request_bytes"]),
+            ms(request.get("connect_ms")),
+            ms(request.get("tls_ms")),
+            ms(request.get("ttfb_ms")),
+            ms(request.get("first_token_ms")),
+            ms(request.get("total_ms")),
+        )
+
+    get_console().print(table)
+
+    prompt_total = sum(
+        r.get("prompt_tokens") or r["estimated_prompt_tokens"] for r in requests
+    )
+    cached_total = sum(r.get("cached_tokens") or 0 for r in requests)
+    completion_total = sum(r.get("completion_tokens") or 0 for r in requests)
+    get_console().print(
+        f"{len(requests)} requests, {prompt_total} prompt tokens "
+        f"({cached_total} served from the provider's prompt cache), "
+        f"{completion_total} completion tokens"
+    )
+
+
+@app.command(name="clear-cache")
+def clear_cache():
+    """Deletes all cached model responses."""
+    removed = 0
+    for path in RESPONSE_CACHE_DIR.glob("*.json"):
+        path.unlink(missing_ok=True)
+        removed += 1
+    for path in SIMILAR_CACHE_DIR.glob("*.json"):
+        path.unlink(missing_ok=True)
+        removed += 1
+    SIMILAR_INDEX_PATH.unlink(missing_ok=True)
+    print(f"Removed {removed} cached responses")
+
+
+@app.command
+def batch(
+    path: Optional[Path] = None,
+    concurrency: int = BATCH_CONCURRENCY,
+    output: Optional[Path] = None,
+):
+    """Runs many prompts concurrently and writes the results as JSONL.
+
+    Prompts are read one per line, either as plain text or as JSON objects with
+    a "prompt" field. Results are written in input order. Commands and scripts
+    in the results are not executed.
+
+    Parameters
+    ----------
+    path: Optional[Path]
+        File to read prompts from. Reads stdin when omitted.
+    concurrency: int
+        Maximum number of requests in flight at once.
+    output: Optional[Path]
+        File to write results to. Writes to stdout when omitted.
+    """
+    config = load_config()
+    if not config.api_key:
+        print(API_KEY_MISSING_MESSAGE)
+        return
+
+    try:
+        lines = path.read_text().splitlines() if path else sys.stdin.read().splitlines()
+        prompts = [parse_batch_line(line) for line in lines if line.strip()]
+    except (IOError, json.JSONDecodeError, KeyError) as e:
+        print(f"Failed to read prompts: {e}")
+        raise SystemExit(1)
+
+    out = open(output, "w") if output else sys.stdout
+    try:
+        run_async(run_batch(prompts, config, max(1, concurrency), out))
+    finally:
+        if output:
+            out.close()
+
+
+# ===== HELPER FUNCTIONS =====
+
+
+async def run_default_action(
+    args: Tuple[str, ...], no_cache: bool, tee: Optional[Path] = None
+):
+    """Answer a single prompt and act on the response."""
+    phases: Dict[str, float] = {}
+    mark = time.perf_counter()
+    phases["startup_ms"] = (mark - PROCESS_START) * 1000
+
+    def end_phase(name: str):
+        nonlocal mark
+        now = time.perf_counter()
+        phases[name] = (now - mark) * 1000
+        mark = now
+
+    config = load_config()
+    end_phase("config_ms")
+
+    # Check API key
+    if not config.api_key:
+        print(API_KEY_MISSING_MESSAGE)
+        return
+
+    # Get user input (editor time is not counted as a phase)
+    user_input = await get_user_input(args)
+    if not user_input:
+        print("No input provided")
+        return
+    mark = time.perf_counter()
+
+    request_prompt_variables.set(await evaluate_prompt_variables(config))
+    end_phase("context_ms")
+
+    # Get and parse response
+    handled = None
+    try:
+        response, notice = (
+            (None, None) if no_cache else lookup_cached_response(user_input, config)
+        )
+        if response is not None:
+            get_console().print(f"[dim]{notice}[/dim]")
+        else:
+            response, handled = await request_response(user_input, config)
+        end_phase("request_ms")
+        parsed = parse_model_response(response)
+        end_phase("parse_ms")
+    except Exception as e:
+        get_console().print(f"[red]Error: {e}[/red]")
+        return
+
+    if not no_cache and notice is None:
+        store_cached_response(user_input, response, config)
+
+    await handle_response(parsed, was_rendered(parsed, handled), tee)
+    end_phase("execute_ms")
+
+    record_run_metrics(
+        phases,
+        config.model_config.get("model", ""),
+        parsed.response_type,
+        cached=notice is not None,
+    )
+
+
+async def request_response(
+    user_input: str, config: AppConfig, history: Optional[List[Dict[str, str]]] = None
+) -> Tuple[str, Optional[Tuple[str, str]]]:
+    """Query the model, streaming the output when enabled.
+
+    Returns the response text and the envelope already handled while streaming,
+    as returned by `render_stream`.
+    """
+    if streams_response(config):
+        return await render_stream(stream_completion(user_input, config, history))
+    return await request_full_response(user_input, config, history), None
+
+
+def streams_response(config: AppConfig) -> bool:
+    """Whether responses are streamed: streaming is on and no models are raced or hedged."""
+    return (
+        config.client_config.get("stream", True)
+        and not config.client_config.get("race_models")
+        and not config.client_config.get("hedge", False)
+    )
+
+
+async def request_full_response(
+    user_input: str, config: AppConfig, history: Optional[List[Dict[str, str]]] = None
+) -> str:
+    """Query the model without streaming, racing or hedging when configured."""
+    race = config.client_config.get("race_models") or []
+    if race:
+        return await race_models(user_input, config, race, history)
+    if config.client_config.get("hedge", False):
+        return await hedged_request(user_input, config, history)
+    return await request_completion(user_input, config, history=history)
+
+
+def with_model(config: AppConfig, model: str) -> AppConfig:
+    """Copy of config that targets a different model."""
+    return replace(config, model_config={**config.model_config, "model": model})
+
+
+async def race_models(
+    user_input: str,
+    config: AppConfig,
+    models: List[str],
+    history: Optional[List[Dict[str, str]]] = None,
+) -> str:
+    """Send the prompt to several models at once and take the first valid answer.
+
+    The first response with a well-formed envelope wins and the other requests
+    are cancelled. If none is well-formed the first one to arrive is used.
+    Racers only retry their own model; the fallback models are tried once,
+    after every racer has failed.
+    """
+    import asyncio
+
+    tasks = [
+        asyncio.create_task(
+            request_completion(
+                user_input, with_model(config, model), history=history, fallback=False
+            )
+        )
+        for model in models
+    ]
+    malformed: Optional[str] = None
+    error: Optional[BaseException] = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                response = await next_done
+            except Exception as e:
+                error = e
+                continue
+            if is_well_formed(response):
+                return response
+            if malformed is None:
+                malformed = response
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if malformed is not None:
+        return malformed
+
+    fallback_models = [
+        model
+        for model in config.client_config.get("fallback_models") or []
+        if model not in models
+    ]
+    if not fallback_models or not RETRY_POLICIES[classify_error(error)]["fallback"]:
+        raise error
+    fallback_config = replace(
+        with_model(config, fallback_models[0]),
+        client_config={**config.client_config, "fallback_models": fallback_models[1:]},
+    )
+    return await request_completion(user_input, fallback_config, history=history)
+
+
+def get_hedge_delay(config: AppConfig) -> float:
+    """Seconds to wait for a first token before hedging, learned from history."""
+    model = config.model_config.get("model", "")
+    sketch = load_sketches().get(f"request:{model}", {}).get("first_token_ms")
+    if sketch is None or sketch.count < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY_MS / 1000
+    return sketch.quantile(HEDGE_QUANTILE) / 1000
+
+
+# Set inside the tasks of a hedged request, so that a cancelled loser can still
+# contribute to the latency sketches
+hedging: contextvars.ContextVar[bool] = contextvars.ContextVar("hedging", default=False)
+
+
+async def hedged_request(
+    user_input: str,
+    config: AppConfig,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> str:
+    """Query the model, sending a duplicate request if the first is unusually slow.
+
+    If the primary request produces no token within the model's observed p90
+    time to first token, the same prompt is sent again (to `hedge_model` when
+    configured) and whichever finishes first is used.
+    """
+    import asyncio
+
+    async def collect(request_config: AppConfig, first_token: asyncio.Event) -> str:
+        hedging.set(True)
+        response = ""
+        async for chunk in stream_completion(user_input, request_config, history):
+            first_token.set()
+            response += chunk
+        return response
+
+    primary_first_token = asyncio.Event()
+    tasks = [asyncio.create_task(collect(config, primary_first_token))]
+    waiter = asyncio.create_task(primary_first_token.wait())
+    error: Optional[BaseException] = None
+    try:
+        done, _ = await asyncio.wait(
+            [tasks[0], waiter],
+            timeout=get_hedge_delay(config),
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if not done:
+            hedge_model = config.client_config.get("hedge_model")
+            hedge_config = with_model(config, hedge_model) if hedge_model else config
+            tasks.append(asyncio.create_task(collect(hedge_config, asyncio.Event())))
+
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                return await next_done
+            except Exception as e:
+                error = e
+    finally:
+        waiter.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(waiter, *tasks, return_exceptions=True)
+
+    raise error
+
+
+# Prompt variables evaluated once for the prompt being answered, or sent by the
+# daemon client that asked it
+request_prompt_variables: contextvars.ContextVar[Optional[Dict[str, str]]] = (
+    contextvars.ContextVar("request_prompt_variables", default=None)
+)
+
+
+async def serve_daemon():
+    """Serve prompts from thin clients on the daemon socket until interrupted."""
+    import asyncio
+
+    if DAEMON_SOCKET_PATH.exists():
+        try:
+            with socket.socket(socket.AF_UNIX) as probe:
+                probe.connect(str(DAEMON_SOCKET_PATH))
+            print(f"A p90 daemon is already listening on {DAEMON_SOCKET_PATH}")
+            return
+        except OSError:
+            # Stale socket left behind by a daemon that didn't shut down cleanly
+            DAEMON_SOCKET_PATH.unlink()
+
+    # Warm the config before the first client arrives
+    load_config()
+
+    USER_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+    server = await asyncio.start_unix_server(
+        handle_daemon_connection, path=str(DAEMON_SOCKET_PATH)
+    )
+    os.chmod(DAEMON_SOCKET_PATH, 0o600)
+    print(f"p90 daemon listening on {DAEMON_SOCKET_PATH}")
+
+    # Shut down cleanly on SIGTERM so the socket file is removed
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.close)
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        print("p90 daemon stopped")
+    finally:
+        DAEMON_SOCKET_PATH.unlink(missing_ok=True)
+
+
+async def handle_daemon_connection(
+    reader: "asyncio.StreamReader", writer: "asyncio.StreamWriter"
+):
+    """Answer one prompt from a thin client, streaming the response back.
+
+    The client sends a single JSON line with the prompt and its own prompt
+    variables (CWD, shell, ...). Replies are JSON lines: "notice" messages,
+    response "chunk"s, then "done" or "error". Raced, hedged and non-streamed
+    responses are sent as a single chunk.
+    """
+
+    async def send(message: Dict[str, Any]):
+        writer.write(json.dumps(message).encode() + b"\n")
+        await writer.drain()
+
+    try:
+        request = json.loads(await reader.readline())
+        user_input = request["prompt"]
+
+        config = load_config()
+        if not config.api_key:
+            await send({"error": API_KEY_MISSING_MESSAGE})
+            return
+        variables = request.get("variables")
+        if variables is None:
+            # Not sent by the client: fall back to the daemon's own environment
+            variables = await evaluate_prompt_variables(config)
+        request_prompt_variables.set(variables)
+
+        response, notice = lookup_cached_response(user_input, config)
+        if response is not None:
+            await send({"notice": notice})
+            await send({"chunk": response})
+        elif streams_response(config):
+            response = ""
+            async for chunk in stream_completion(user_input, config):
+                response += chunk
+                await send({"chunk": chunk})
+            store_cached_response(user_input, response, config)
+        else:
+            response = await request_full_response(user_input, config)
+            await send({"chunk": response})
+            store_cached_response(user_input, response, config)
+
+        await send({"done": True})
+    except Exception as e:
+        try:
+            await send({"error": str(e)})
+        except OSError:
+            pass
+    finally:
+        writer.close()
+
+
+async def run_daemon_client(user_input: str, tee: Optional[Path] = None) -> bool:
+    """Send a prompt to the running daemon and act on the streamed response.
+
+    Returns False if no daemon could be reached, so the caller can fall back to
+    answering the prompt in this process.
+    """
+    import asyncio
+
+    phases: Dict[str, float] = {}
+    mark = time.perf_counter()
+    phases["startup_ms"] = (mark - PROCESS_START) * 1000
+
+    def end_phase(name: str):
+        nonlocal mark
+        now = time.perf_counter()
+        phases[name] = (now - mark) * 1000
+        mark = now
+
+    try:
+        reader, writer = await asyncio.open_unix_connection(str(DAEMON_SOCKET_PATH))
+    except OSError:
+        return False
+
+    config = load_config()
+    end_phase("config_ms")
+    variables = await evaluate_prompt_variables(config)
+    end_phase("context_ms")
+    request = {"prompt": user_input, "variables": variables}
+    writer.write(json.dumps(request).encode() + b"\n")
+    cached = False
+
+    async def chunks() -> AsyncIterator[str]:
+        nonlocal cached
+        while line := await reader.readline():
+            message = json.loads(line)
+            if "notice" in message:
+                cached = True
+                get_console().print(f"[dim]{message['notice']}[/dim]")
+            elif "chunk" in message:
+                yield message["chunk"]
+            elif "error" in message:
+                raise RuntimeError(message["error"])
+            elif message.get("done"):
+                return
+        raise RuntimeError("Connection to p90 daemon closed unexpectedly")
+
+    try:
+        response, handled = await render_stream(chunks())
+        end_phase("request_ms")
+        parsed = parse_model_response(response)
+        end_phase("parse_ms")
+    except Exception as e:
+        get_console().print(f"[red]Error: {e}[/red]")
+        return True
+    finally:
+        writer.close()
+
+    await handle_response(parsed, was_rendered(parsed, handled), tee)
+    end_phase("execute_ms")
+
+    record_run_metrics(
+        phases, config.model_config.get("model", ""), parsed.response_type, cached
+    )
+    return True
+
+
+async def run_repl(session: Optional[str] = None, tee: Optional[Path] = None):
+    """Answer prompts in a loop, keeping the client warm and a bounded history."""
+    config = load_config()
+    max_turns = config.client_config.get("repl_history_turns", REPL_HISTORY_TURNS)
+    history = load_conversation(session, 2 * max_turns) if session else []
+    if history:
+        get_console().print(
+            f"[dim]Resumed session '{session}' with {len(history) // 2} earlier turns.[/dim]"
+        )
+    get_console().print("[dim]Type 'exit' or press Ctrl-D to quit.[/dim]")
+
+    while True:
+        try:
+            user_input = input("p90> ").strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+
+        if user_input in ("exit", "quit"):
+            break
+        if not user_input:
+            continue
+
+        # Cheap after the first turn: only reloads when the files change
+        config = load_config()
+        if not config.api_key:
+            print(API_KEY_MISSING_MESSAGE)
+            return
+        request_prompt_variables.set(await evaluate_prompt_variables(config))
+
+        budget = config.client_config.get("history_token_budget", HISTORY_TOKEN_BUDGET)
+        try:
+            response, handled = await request_response(
+                user_input, config, compact_history(history, budget)
+            )
+            parsed = parse_model_response(response)
+        except Exception as e:
+            get_console().print(f"[red]Error: {e}[/red]")
+            continue
+
+        await handle_response(parsed, was_rendered(parsed, handled), tee)
+
+        turn = [
+            {"role": "user", "content": user_input},
+            {"role": "assistant", "content": response},
+        ]
+        history.extend(turn)
+        if session:
+            append_conversation(session, turn)
+        max_turns = config.client_config.get("repl_history_turns", REPL_HISTORY_TURNS)
+        del history[: max(0, len(history) - 2 * max_turns)]
+
+
+def percentile_table(title: str, groups: Dict[str, Dict[str, QuantileSketch]]):
+    """Build a table of p50/p90/p99 per group and metric."""
+    from rich.table import Table
+
+    table = Table(title=title)
+    table.add_column("Group", style="cyan")
+    table.add_column("Metric")
+    table.add_column("Count", justify="right")
+    table.add_column("p50 ms", justify="right")
+    table.add_column("p90 ms", justify="right", style="magenta")
+    table.add_column("p99 ms", justify="right")
+
+    for group, metrics in sorted(groups.items()):
+        for metric, sketch in metrics.items():
+            table.add_row(
+                group,
+                metric.removesuffix("_ms"),
+                str(sketch.count),
+                *(f"{sketch.quantile(q):.0f}" for q in (0.5, 0.9, 0.99)),
+            )
+    return table
+
+
+def load_request_metrics() -> List[Dict[str, Any]]:
+    """Load all recorded request metrics, oldest first."""
+    try:
+        with open(REQUEST_METRICS_PATH) as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+
+    requests = []
+    for line in lines:
+        try:
+            requests.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return requests
+
+
+def get_conversation_path(session: str) -> Path:
+    """Get the log file for a named conversation."""
+    if not re.fullmatch(r"[\w.-]+", session):
+        print(f"Invalid session name '{session}': use letters, digits, '.', '-' or '_'")
+        raise SystemExit(1)
+    return CONVERSATIONS_DIR / f"{session}.jsonl"
+
+
+def load_conversation(session: str, limit: int) -> List[Dict[str, str]]:
+    """Load the last `limit` messages of a conversation log."""
+    path = get_conversation_path(session)
+    if not path.exists():
+        return []
+
+    with open(path) as f:
+        lines = collections.deque(f, maxlen=limit)
+
+    messages = []
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            # A torn write at the end of the log
+            continue
+        messages.append({"role": entry["role"], "content": entry["content"]})
+
+    # Never start the history halfway through a turn
+    while messages and messages[0]["role"] != "user":
+        messages.pop(0)
+    return messages
+
+
+def append_conversation(session: str, messages: List[Dict[str, str]]):
+    """Append messages to a conversation log."""
+    CONVERSATIONS_DIR.mkdir(parents=True, exist_ok=True)
+    now = time.time()
+    with open(get_conversation_path(session), "a") as f:
+        for message in messages:
+            f.write(json.dumps({**message, "time": now}) + "\n")
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the token count of text (about four characters per token)."""
+    return (len(text) + 3) // 4
+
+
+def compact_history(history: List[Dict[str, str]], budget: int) -> List[Dict[str, str]]:
+    """Trim history to fit a token budget, keeping the most recent turns.
+
+    Dropped turns are replaced by one short message listing their questions, so
+    the model still knows what was discussed.
+    """
+    kept: List[Dict[str, str]] = []
+    used = 0
+    # Walk backwards over (user, assistant) pairs
+    for start in range(len(history) - 2, -1, -2):
+        turn = history[start : start + 2]
+        cost = sum(estimate_tokens(message["content"]) for message in turn)
+        if used + cost > budget:
+            break
+        kept[:0] = turn
+        used += cost
+
+    dropped = history[: len(history) - len(kept)]
+    if not dropped:
+        return kept
+
+    questions = [
+        message["content"][:HISTORY_SUMMARY_QUESTION_CHARS]
+        for message in dropped
+        if message["role"] == "user"
+    ]
+    summary = "Earlier in this conversation the user asked:\n" + "\n".join(
+        f"- {question}" for question in questions
+    )
+    # The summary itself must also fit, so drop its oldest questions first
+    while questions and used + estimate_tokens(summary) > budget:
+        questions.pop(0)
+        summary = "Earlier in this conversation the user asked:\n" + "\n".join(
+            f"- {question}" for question in questions
+        )
+    if not questions:
+        return kept
+
+    return [
+        {"role": "user", "content": summary},
+        {"role": "assistant", "content": "<response>Noted.</response>"},
+        *kept,
+    ]
+
+
+async def handle_response(
+    parsed: ParsedResponse, rendered: bool = False, tee: Optional[Path] = None
+):
+    """Display, execute or save a parsed response.
+
+    `rendered` marks a response already displayed or saved while streaming.
+    """
+    if parsed.response_type == "response":
+        if not rendered:
+            from rich.markdown import Markdown
+
+            get_console().print(Markdown(parsed.content))
+
+    elif parsed.response_type == "cli":
+        await execute_command(parsed.content, tee)
+
+    elif parsed.response_type == "python-script":
+        SCRIPTS_DIR.mkdir(parents=True, exist_ok=True)
+        script_path = SCRIPTS_DIR / parsed.script_name
+
+        if not rendered:
+            with open(script_path, "w") as f:
+                f.write(parsed.script_body)
+
+        print(f"Saved script to {script_path}")
+        record_script(script_path)
+        exit_status = await execute_command(f"python {script_path}", tee)
+        record_script_run(parsed.script_name, exit_status)
+
+
+@functools.cache
+def get_script_catalog() -> "sqlite3.Connection":
+    """Open the script catalog, creating it on first use."""
+    import sqlite3
+
+    USER_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+    catalog = sqlite3.connect(SCRIPT_CATALOG_PATH, timeout=5, isolation_level=None)
+    catalog.row_factory = sqlite3.Row
+    catalog.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS scripts (
+            name TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            summary TEXT,
+            run_count INTEGER NOT NULL DEFAULT 0,
+            last_run REAL,
+            last_exit_status INTEGER,
+            mtime_ns INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        );
+        """
+    )
+    # Catalogs created before mtimes were tracked
+    columns = {row["name"] for row in catalog.execute("PRAGMA table_info(scripts)")}
+    if "mtime_ns" not in columns:
+        catalog.execute("ALTER TABLE scripts ADD COLUMN mtime_ns INTEGER")
+    return catalog
+
+
+def sync_script_catalog(catalog: "sqlite3.Connection"):
+    """Catch the catalog up with scripts added or removed outside p90.
+
+    Only runs when the scripts directory's mtime has changed, so listing
+    thousands of scripts doesn't stat every file. Scripts edited in place are
+    picked up by `refresh_script_catalog`.
+    """
+    SCRIPTS_DIR.mkdir(parents=True, exist_ok=True)
+    mtime_ns = SCRIPTS_DIR.stat().st_mtime_ns
+    row = catalog.execute(
+        "SELECT value FROM catalog_state WHERE key = 'scripts_dir_mtime_ns'"
+    ).fetchone()
+    if row is not None and row["value"] == mtime_ns:
+        return
+
+    on_disk = {path.name: path for path in SCRIPTS_DIR.glob("*.py")}
+    cataloged = {row["name"] for row in catalog.execute("SELECT name FROM scripts")}
+    for name in cataloged - on_disk.keys():
+        remove_script(name)
+    for name in on_disk.keys() - cataloged:
+        record_script(on_disk[name])
+    catalog.execute(
+        "INSERT OR REPLACE INTO catalog_state VALUES ('scripts_dir_mtime_ns', ?)",
+        (mtime_ns,),
+    )
+
+
+def refresh_script_catalog(catalog: "sqlite3.Connection"):
+    """Re-record cataloged scripts whose file changed since, stat'ing each one."""
+    for row in catalog.execute("SELECT name FROM scripts").fetchall():
+        script_path = SCRIPTS_DIR / row["name"]
+        if script_path.exists():
+            record_script(script_path)
+        else:
+            remove_script(row["name"])
+
+
+def record_script(script_path: Path):
+    """Add a saved script to the catalog or update its entry if the file changed.
+
+    The creation time and run history of an existing entry are kept.
+    """
+    import sqlite3
+
+    try:
+        stat = script_path.stat()
+        catalog = get_script_catalog()
+        row = catalog.execute(
+            "SELECT mtime_ns, size FROM scripts WHERE name = ?", (script_path.name,)
+        ).fetchone()
+        if row is not None and (row["mtime_ns"], row["size"]) == (
+            stat.st_mtime_ns,
+            stat.st_size,
+        ):
+            return
+
+        source = script_path.read_bytes()
+        catalog.execute(
+            "INSERT INTO scripts (name, hash, size, created, summary, mtime_ns) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET hash = excluded.hash, "
+            "size = excluded.size, summary = excluded.summary, "
+            "mtime_ns = excluded.mtime_ns",
+            (
+                script_path.name,
+                hashlib.sha256(source).hexdigest(),
+                len(source),
+                stat.st_mtime,
+                get_script_summary(source.decode(errors="replace")),
+                stat.st_mtime_ns,
+            ),
+        )
+    except (OSError, sqlite3.Error):
+        pass
+
+
+def record_script_run(script_name: str, exit_status: int):
+    """Count a run of a cataloged script and remember its exit status."""
+    import sqlite3
+
+    try:
+        get_script_catalog().execute(
+            "UPDATE scripts SET run_count = run_count + 1, last_run = ?, "
+            "last_exit_status = ? WHERE name = ?",
+            (time.time(), exit_status, script_name),
+        )
+    except sqlite3.Error:
+        pass
+
+
+def remove_script(script_name: str):
+    """Drop a script from the catalog."""
+    import sqlite3
+
+    try:
+        get_script_catalog().execute(
+            "DELETE FROM scripts WHERE name = ?", (script_name,)
+        )
+    except sqlite3.Error:
+        pass
+
+
+def get_script_summary(source: str) -> Optional[str]:
+    """First line of a script's module docstring, which the system prompt asks for."""
+    import ast
+
+    try:
+        docstring = ast.get_docstring(ast.parse(source))
+    except (SyntaxError, ValueError):
+        return None
+    return docstring.strip().split("\n", 1)[0] if docstring else None
+
+
+def ensure_config_exists():
+    """Ensure config directory and files exist, recreating from defaults if needed."""
+    USER_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Handle config.json
+    if not CONFIG_PATH.exists():
+        try:
+            default_config = json.loads(app_config)
+            save_json(CONFIG_PATH, default_config)
+        except Exception as e:
+            print(f"Failed to create config from defaults: {e}")
+            raise SystemExit(1)
+
+    # Handle system_prompt.md
+    if not SYSTEM_PROMPT_PATH.exists():
+        try:
+            with open(SYSTEM_PROMPT_PATH, "w") as f:
+                f.write(app_system_prompt)
+        except Exception as e:
+            print(f"Failed to create system prompt from defaults: {e}")
+            raise SystemExit(1)
+
+
+def load_json(path: Path) -> Dict[str, Any]:
+    """Load JSON file."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(path: Path, data: Dict[str, Any]):
+    """Save JSON file."""
+    with open(path, "w") as f:
+        json.dump(data, f, indent=4)
+
+
+@functools.cache
+def get_console() -> "Console":
+    """Get the shared rich console, importing rich on first use."""
+    from rich.console import Console
+
+    return Console()
+
+
+def get_editor() -> str:
+    """Get the user's preferred editor."""
+    return os.environ.get("EDITOR", "nano")
+
+
+_config_cache: Optional[Tuple[Tuple[int, int], AppConfig]] = None
+
+
+def load_config() -> AppConfig:
+    """Load and validate the config and system prompt.
+
+    The result is cached for the life of the process and only reloaded when
+    either file's mtime changes.
+    """
+    global _config_cache
+    try:
+        try:
+            stamp = (
+                CONFIG_PATH.stat().st_mtime_ns,
+                SYSTEM_PROMPT_PATH.stat().st_mtime_ns,
+            )
+        except FileNotFoundError:
+            ensure_config_exists()
+            stamp = (
+                CONFIG_PATH.stat().st_mtime_ns,
+                SYSTEM_PROMPT_PATH.stat().st_mtime_ns,
+            )
+
+        if _config_cache is not None and _config_cache[0] == stamp:
+            return _config_cache[1]
+
+        data = load_json(CONFIG_PATH)
+        with open(SYSTEM_PROMPT_PATH) as f:
+            system_prompt = f.read()
+    except (json.JSONDecodeError, IOError, OSError) as e:
+        print(f"Failed to read config: {e}")
+        raise SystemExit(1)
+
+    config = validate_config(data, system_prompt)
+    _config_cache = (stamp, config)
+    return config
+
+
+def validate_config(data: Any, system_prompt: str) -> AppConfig:
+    """Validate raw config data and split it into API key, model and client settings."""
+    if not isinstance(data, dict):
+        print(f"Invalid config in {CONFIG_PATH}: expected a JSON object")
+        raise SystemExit(1)
+
+    model = data.get("model")
+    if not isinstance(model, str) or not model:
+        print(f"Invalid config in {CONFIG_PATH}: 'model' must be a non-empty string")
+        raise SystemExit(1)
+
+    api_key = data.get("openrouter_api_key") or ""
+    if not isinstance(api_key, str):
+        print(f"Invalid config in {CONFIG_PATH}: 'openrouter_api_key' must be a string")
+        raise SystemExit(1)
+
+    return AppConfig(
+        api_key=api_key,
+        model_config={k: v for k, v in data.items() if k not in CLIENT_CONFIG_KEYS},
+        client_config={
+            k: v
+            for k, v in data.items()
+            if k in CLIENT_CONFIG_KEYS and k != "openrouter_api_key"
+        },
+        system_prompt=system_prompt,
+    )
+
+
+def get_api_headers(config: AppConfig) -> Optional[Dict[str, str]]:
+    """Get OpenRouter API headers."""
+    if not config.api_key:
+        return None
+
+    return {
+        "Authorization": f"Bearer {config.api_key}",
+        "Content-Type": "application/json",
+    }
+
+
+# Providers for `${{NAME}}` prompt variables and whether they block
+PROMPT_VARIABLE_PROVIDERS: Dict[str, Tuple[Callable[[], str], bool]] = {}
+
+
+def prompt_variable(name: str, blocking: bool = False):
+    """Register a provider for the `${{NAME}}` prompt variable.
+
+    Blocking providers (subprocesses, directory scans) run on worker threads in
+    parallel under the prompt variable budget.
+    """
+
+    def register(provider: Callable[[], str]) -> Callable[[], str]:
+        PROMPT_VARIABLE_PROVIDERS[name] = (provider, blocking)
+        return provider
+
+    return register
+
+
+@prompt_variable("OS")
+def prompt_os() -> str:
+    return os.name
+
+
+@prompt_variable("CWD")
+def prompt_cwd() -> str:
+    return os.getcwd()
+
+
+@prompt_variable("DATE")
+def prompt_date() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+@prompt_variable("SHELL")
+def prompt_shell() -> str:
+    return os.environ.get("SHELL", "unknown")
+
+
+@prompt_variable("CPU_COUNT")
+def prompt_cpu_count() -> str:
+    return str(os.cpu_count() or "unknown")
+
+
+@prompt_variable("GIT_BRANCH", blocking=True)
+def prompt_git_branch() -> str:
+    result = subprocess.run(
+        ["git", "rev-parse", "--abbrev-ref", "HEAD"],
+        capture_output=True,
+        text=True,
+        timeout=PROMPT_COMMAND_TIMEOUT,
+    )
+    return result.stdout.strip() if result.returncode == 0 else "none"
+
+
+@prompt_variable("DIR_LISTING", blocking=True)
+def prompt_dir_listing() -> str:
+    with os.scandir() as entries:
+        names = sorted(
+            entry.name + ("/" if entry.is_dir() else "") for entry in entries
+        )
+    if len(names) > DIR_LISTING_MAX_ENTRIES:
+        hidden = len(names) - DIR_LISTING_MAX_ENTRIES
+        names = names[:DIR_LISTING_MAX_ENTRIES] + [f"... and {hidden} more"]
+    return "\n".join(names)
+
+
+@prompt_variable("DIR_SUMMARY", blocking=True)
+def prompt_dir_summary() -> str:
+    return summarize_dir_index(refresh_dir_index(os.getcwd()))
+
+
+def refresh_dir_index(root: str) -> Dict[str, Dict[str, Any]]:
+    """Bring the on-disk index of the tree under root up to date and return it.
+
+    Directories whose mtime is unchanged keep their recorded entries, so a
+    refresh costs one stat per directory plus a scandir of those where files
+    were added, removed or renamed. Files modified in place keep their
+    recorded size until their directory changes.
+    """
+    path = DIR_INDEX_DIR / f"{hashlib.sha256(root.encode()).hexdigest()[:16]}.json"
+    try:
+        previous = load_json(path)["dirs"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        previous = {}
+
+    dirs = {}
+    changed = False
+    pending = [""]
+    while pending and len(dirs) < DIR_INDEX_MAX_DIRS:
+        relative = pending.pop()
+        try:
+            mtime_ns = os.stat(os.path.join(root, relative)).st_mtime_ns
+        except OSError:
+            continue
+
+        entry = previous.get(relative)
+        if entry is None or entry["mtime_ns"] != mtime_ns:
+            entry = scan_directory(os.path.join(root, relative), mtime_ns)
+            changed = True
+        dirs[relative] = entry
+        pending.extend(os.path.join(relative, name) for name in entry["subdirs"])
+
+    if changed or dirs.keys() != previous.keys():
+        try:
+            DIR_INDEX_DIR.mkdir(parents=True, exist_ok=True)
+            temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(temp_path, "w") as f:
+                json.dump({"root": root, "dirs": dirs}, f)
+            os.replace(temp_path, path)
+        except OSError:
+            pass
+    return dirs
+
+
+def scan_directory(path: str, mtime_ns: int) -> Dict[str, Any]:
+    """Index entry for one directory: subdirectories, file counts by extension and largest files."""
+    subdirs = []
+    counts = {}
+    files = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in DIR_INDEX_SKIP:
+                            subdirs.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        extension = os.path.splitext(entry.name)[1].lower() or "(none)"
+                        counts[extension] = counts.get(extension, 0) + 1
+                        files.append(
+                            (entry.stat(follow_symlinks=False).st_size, entry.name)
+                        )
+                except OSError:
+                    continue
+    except OSError:
+        pass
+
+    return {
+        "mtime_ns": mtime_ns,
+        "subdirs": sorted(subdirs),
+        "counts": counts,
+        "files": len(files),
+        "bytes": sum(size for size, _ in files),
+        "largest": sorted(files, reverse=True)[:DIR_SUMMARY_LARGEST],
+    }
+
+
+def summarize_dir_index(dirs: Dict[str, Dict[str, Any]]) -> str:
+    """Summarize an index: totals, counts by extension, largest files and a shallow tree."""
+    counts = collections.Counter()
+    largest = []
+    for relative, entry in dirs.items():
+        counts.update(entry["counts"])
+        largest.extend(
+            (size, os.path.join(relative, name)) for size, name in entry["largest"]
+        )
+
+    # Recursive file counts, children before parents
+    totals = {}
+    for relative in sorted(dirs, key=lambda r: r.count(os.sep) + bool(r), reverse=True):
+        entry = dirs[relative]
+        totals[relative] = entry["files"] + sum(
+            totals.get(os.path.join(relative, name), 0) for name in entry["subdirs"]
+        )
+
+    total_bytes = sum(entry["bytes"] for entry in dirs.values())
+    lines = [
+        f"Files: {totals.get('', 0)} ({format_size(total_bytes)}) in {len(dirs)} directories"
+    ]
+    if len(dirs) >= DIR_INDEX_MAX_DIRS:
+        lines.append(
+            f"(partial: indexing stopped after {DIR_INDEX_MAX_DIRS} directories)"
+        )
+
+    lines.append(
+        "By extension: "
+        + ", ".join(
+            f"{extension} {count}"
+            for extension, count in counts.most_common(DIR_SUMMARY_EXTENSIONS)
+        )
+    )
+    lines.append("Largest files:")
+    for size, name in sorted(largest, reverse=True)[:DIR_SUMMARY_LARGEST]:
+        lines.append(f"  {format_size(size)}  {name}")
+
+    lines.append("Tree:")
+
+    def add_tree(relative: str, depth: int):
+        subdirs = dirs[relative]["subdirs"] if relative in dirs else []
+        for name in subdirs[:DIR_SUMMARY_TREE_WIDTH]:
+            child = os.path.join(relative, name)
+            lines.append(f"{'  ' * depth}{name}/ ({totals.get(child, 0)} files)")
+            if depth < DIR_SUMMARY_TREE_DEPTH:
+                add_tree(child, depth + 1)
+        if len(subdirs) > DIR_SUMMARY_TREE_WIDTH:
+            hidden = len(subdirs) - DIR_SUMMARY_TREE_WIDTH
+            lines.append(f"{'  ' * depth}... and {hidden} more directories")
+
+    add_tree("", 1)
+    return "\n".join(lines)
+
+
+def format_size(size: int) -> str:
+    """Format a byte count for humans."""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+@prompt_variable("TOOLS", blocking=True)
+def prompt_tools() -> str:
+    tools = get_environment_probe()["tools"]
+    installed = [
+        f"{name} {version}".rstrip()
+        for name, version in tools.items()
+        if version is not None
+    ]
+    missing = [name for name, version in tools.items() if version is None]
+    summary = ", ".join(installed) or "none"
+    return f"{summary} (not installed: {', '.join(missing)})" if missing else summary
+
+
+@prompt_variable("MEMORY", blocking=True)
+def prompt_memory() -> str:
+    memory = get_environment_probe()["memory"]
+    return format_size(memory) if memory else "unknown"
+
+
+@prompt_variable("PYTHON_VERSION", blocking=True)
+def prompt_python_version() -> str:
+    return get_environment_probe()["python"] or "not installed"
+
+
+# Serializes the first probe when several variables need it at once
+environment_probe_lock = threading.Lock()
+
+
+def get_environment_probe() -> Dict[str, Any]:
+    """Get the cached environment probe for this host, probing again if PATH changed.
+
+    The cache key covers PATH and the mtimes of its directories, so installing
+    or removing a tool also triggers a new probe.
+    """
+    host = socket.gethostname()
+    fingerprint = hashlib.sha256(
+        json.dumps(
+            [
+                (entry, get_mtime_ns(entry))
+                for entry in os.environ.get("PATH", "").split(os.pathsep)
+            ]
+        ).encode()
+    ).hexdigest()
+
+    with environment_probe_lock:
+        try:
+            probes = load_json(ENVIRONMENT_PROBE_PATH)
+        except (FileNotFoundError, json.JSONDecodeError):
+            probes = {}
+
+        probe = probes.get(host)
+        if probe is not None and probe.get("path_fingerprint") == fingerprint:
+            return probe
+
+        probe = {"path_fingerprint": fingerprint, **probe_environment()}
+        probes[host] = probe
+        try:
+            USER_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+            temp_path = ENVIRONMENT_PROBE_PATH.with_suffix(f".{os.getpid()}.tmp")
+            save_json(temp_path, probes)
+            os.replace(temp_path, ENVIRONMENT_PROBE_PATH)
+        except OSError:
+            pass
+        return probe
+
+
+def get_mtime_ns(path: str) -> Optional[int]:
+    """Get a path's mtime, or None if it doesn't exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def probe_environment() -> Dict[str, Any]:
+    """Find the installed tools and their versions, total memory and the Python version."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    paths = {name: shutil.which(name) for name in PROBED_TOOLS}
+    python = shutil.which("python") or shutil.which("python3")
+    with ThreadPoolExecutor(max_workers=len(PROBED_TOOLS) + 1) as executor:
+        versions = dict(
+            zip(
+                paths,
+                executor.map(
+                    lambda path: path and get_tool_version(path), paths.values()
+                ),
+            )
+        )
+        python_version = python and get_tool_version(python)
+
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        memory = None
+
+    return {"tools": versions, "memory": memory, "python": python_version}
+
+
+def get_tool_version(path: str) -> str:
+    """Version reported by `tool --version`, or an empty string if it has none."""
+    try:
+        result = subprocess.run(
+            [path, "--version"],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            timeout=TOOL_VERSION_TIMEOUT,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return ""
+
+    output = result.stdout or result.stderr
+    match = re.search(r"\d+(?:\.\d+)+", output.split("\n", 1)[0])
+    return match.group() if match else ""
+
+
+def run_prompt_command(command: str) -> str:
+    """Output of a shell command defined as a prompt variable in the config."""
+    result = subprocess.run(
+        command,
+        shell=True,
+        capture_output=True,
+        text=True,
+        timeout=PROMPT_COMMAND_TIMEOUT,
+    )
+    return result.stdout.strip()
+
+
+def get_prompt_variables(names: List[str], config: AppConfig) -> Dict[str, str]:
+    """Get the values of the named prompt variables.
+
+    These are evaluated once per prompt by `evaluate_prompt_variables` (or by
+    the daemon client that sent it) and must be set before the prompt is built.
+    """
+    request_variables = request_prompt_variables.get()
+    if request_variables is None:
+        raise RuntimeError("Prompt variables have not been evaluated for this request")
+    return {
+        name: request_variables[name] for name in names if name in request_variables
+    }
+
+
+async def evaluate_prompt_variables(config: AppConfig) -> Dict[str, str]:
+    """Evaluate every variable the system prompt references, once per prompt.
+
+    Blocking providers run on daemon threads while the event loop carries on;
+    unlike `asyncio.to_thread`, a provider that overruns then holds up neither
+    the loop's shutdown nor process exit.
+    """
+    import asyncio
+
+    names = compile_prompt(config.system_prompt).variables
+    values, blocking = get_prompt_variable_providers(names, config)
+    if not blocking:
+        return values
+
+    loop = asyncio.get_running_loop()
+    futures = {name: loop.create_future() for name in blocking}
+
+    def resolve(future: "asyncio.Future", value: str):
+        if not future.done():
+            future.set_result(value)
+
+    def evaluate(name: str, provider: Callable[[], str]):
+        try:
+            value = provider()
+        except Exception:
+            value = "unavailable"
+        try:
+            loop.call_soon_threadsafe(resolve, futures[name], value)
+        except RuntimeError:
+            # The loop finished while the provider was still running
+            pass
+
+    for name, provider in blocking.items():
+        threading.Thread(target=evaluate, args=(name, provider), daemon=True).start()
+
+    await asyncio.wait(futures.values(), timeout=get_prompt_budget(config))
+    for name, future in futures.items():
+        if future.done():
+            values[name] = future.result()
+        else:
+            future.cancel()
+            values[name] = "unavailable (timed out)"
+    return values
+
+
+def get_prompt_variable_providers(
+    names: List[str], config: AppConfig
+) -> Tuple[Dict[str, str], Dict[str, Callable[[], str]]]:
+    """Split the named variables into values of cheap providers and blocking providers to run.
+
+    Variables defined as shell commands under `prompt_variables` in the config
+    take precedence over the built-in providers.
+    """
+    commands = config.client_config.get("prompt_variables") or {}
+    values = {}
+    blocking = {}
+    for name in names:
+        if name in commands:
+            blocking[name] = functools.partial(run_prompt_command, commands[name])
+        elif name in PROMPT_VARIABLE_PROVIDERS:
+            provider, is_blocking = PROMPT_VARIABLE_PROVIDERS[name]
+            if is_blocking:
+                blocking[name] = provider
+            else:
+                values[name] = provider()
+    return values, blocking
+
+
+def get_prompt_budget(config: AppConfig) -> float:
+    """Seconds blocking prompt variable providers may take."""
+    return (
+        config.client_config.get("prompt_variable_budget_ms", PROMPT_VARIABLE_BUDGET_MS)
+        / 1000
+    )
+
+
+@functools.lru_cache(maxsize=4)
+def compile_prompt(content: str) -> PromptTemplate:
+    """Parse a prompt template once; the config is only reloaded when its mtime changes."""
+    return PromptTemplate(tuple(PROMPT_VARIABLE_PATTERN.split(content)))
+
+
+def get_system_prompt_parts(config: AppConfig) -> Tuple[str, str]:
+    """Split the system prompt into a static prefix and a hydrated dynamic suffix.
+
+    The prefix ends where the section containing the first variable begins, so
+    it is byte-identical across calls and can be cached by the provider.
+    """
+    static, dynamic = split_system_prompt(config.system_prompt)
+    template = compile_prompt(dynamic)
+    return static, template.render(get_prompt_variables(template.variables, config))
+
+
+def split_system_prompt(content: str) -> Tuple[str, str]:
+    """Split a prompt template before the Markdown section holding its first variable."""
+    first_variable = content.find("${{")
+    if first_variable == -1:
+        return content, ""
+
+    section_start = content.rfind("\n#", 0, first_variable)
+    if section_start == -1:
+        return "", content
+    return content[: section_start + 1], content[section_start + 1 :]
+
+
+def supports_cache_control(model: str) -> bool:
+    """Whether the model needs explicit cache_control breakpoints for prompt caching.
+
+    Other providers on OpenRouter cache stable prefixes automatically.
+    """
+    return model.startswith(PROMPT_CACHE_CONTROL_PREFIXES)
+
+
+def build_system_message(config: AppConfig) -> Dict[str, Any]:
+    """Build the system message with its static prefix marked for prompt caching.
+
+    The prefix is only marked when it is long enough for the provider to cache.
+    """
+    static, dynamic = get_system_prompt_parts(config)
+    if estimate_tokens(static) < PROMPT_CACHE_MIN_TOKENS or not supports_cache_control(
+        config.model_config.get("model", "")
+    ):
+        return {"role": "system", "content": static + dynamic}
+
+    parts = [{"type": "text", "text": static, "cache_control": {"type": "ephemeral"}}]
+    if dynamic:
+        parts.append({"type": "text", "text": dynamic})
+    return {"role": "system", "content": parts}
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    """Text of a chat message whose content is a string or a list of text parts."""
+    content = message["content"]
+    if isinstance(content, str):
+        return content
+    return "".join(part.get("text", "") for part in content)
+
+
+def get_model_config(config: AppConfig) -> Dict[str, Any]:
+    """Get model configuration without API key or client settings."""
+    return dict(config.model_config)
+
+
+async def get_user_input(args) -> Optional[str]:
+    """Get user input from args or editor."""
+    import asyncio
+
+    if args:
+        return " ".join(args)
+
+    with tempfile.NamedTemporaryFile(mode="w+", suffix=".txt", delete=False) as f:
+        temp_path = f.name
+
+    editor = await asyncio.create_subprocess_exec(get_editor(), temp_path)
+    await editor.wait()
+
+    with open(temp_path) as f:
+        user_input = f.read().strip()
+
+    os.unlink(temp_path)
+    return user_input if user_input else None
+
 
+_http_client: Optional["httpx.AsyncClient"] = None
 
-@app.default
-def default_action(*args):
-    """Main command handler."""
-    # Check API key
-    if not get_api_headers():
-        print(
-            "OpenRouter API key not configured. Please run 'p90 config' to set your openrouter_api_key."
-        )
-        return
 
-    # Get user input
-    user_input = get_user_input(args)
-    if not user_input:
-        print("No input provided")
-        return
+def create_async_http_client(
+    max_connections: int = HTTP_MAX_CONNECTIONS,
+) -> "httpx.AsyncClient":
+    """Create an async HTTP client tuned for keep-alive.
 
-    # Get and parse response
-    try:
-        response = call_openrouter_api(user_input)
-        parsed = parse_model_response(response)
-    except Exception as e:
-        console.print(f"[red]Error: {e}[/red]")
-        return
+    HTTP/2 is used when the optional `h2` package is installed.
+    """
+    import httpx
 
-    # Handle response types
-    if parsed.response_type == "response":
-        console.print(Markdown(parsed.content))
+    return httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(
+                max_connections, HTTP_MAX_KEEPALIVE_CONNECTIONS
+            ),
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
 
-    elif parsed.response_type == "cli":
-        execute_command(parsed.content)
 
-    elif parsed.response_type == "python-script":
-        SCRIPTS_DIR.mkdir(parents=True, exist_ok=True)
-        script_path = SCRIPTS_DIR / parsed.script_name
+def get_http_client() -> "httpx.AsyncClient":
+    """Get the process-wide HTTP client, creating it on first use.
 
-        with open(script_path, "w") as f:
-            f.write(parsed.script_body)
+    Reusing one client keeps connections alive between requests, so only the
+    first call pays for the TCP and TLS handshake. The client is closed by
+    `run_async` when its event loop finishes.
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = create_async_http_client()
+    return _http_client
 
-        print(f"Saved script to {script_path}")
-        execute_command(f"python {script_path}")
 
+async def close_http_client():
+    """Close the process-wide HTTP client if it was created."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
 
-@app.command
-def config():
-    """Opens the model and sampler config in the default editor."""
-    ensure_config_exists()
-    subprocess.run([get_editor(), str(CONFIG_PATH)])
 
+def run_async(coro):
+    """Run a coroutine from a synchronous command, then close the shared HTTP client."""
+    import asyncio
 
-@app.command
-def reset():
-    """Resets the config and system prompt back to the defaults."""
-    # Preserve API key if it exists
-    api_key = None
-    if CONFIG_PATH.exists():
+    async def runner():
         try:
-            api_key = load_json(CONFIG_PATH).get("openrouter_api_key")
-        except:
-            pass
-
-    # Copy defaults
-    default_config = json.loads(app_config)
-    if api_key:
-        default_config["openrouter_api_key"] = api_key
+            return await coro
+        finally:
+            await close_http_client()
 
-    ensure_config_exists()
-    save_json(CONFIG_PATH, default_config)
+    return asyncio.run(runner())
 
-    # Copy system prompt
-    with open(SYSTEM_PROMPT_PATH, "w") as f:
-        f.write(app_system_prompt)
 
-    print("Config and system prompt reset to defaults (API key preserved)")
+def build_payload(
+    user_input: str,
+    config: AppConfig,
+    stream: bool = False,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> Dict[str, Any]:
+    """Build the chat completion payload for OpenRouter.
 
+    `history` holds earlier user and assistant messages of the conversation.
+    """
+    return {
+        "messages": [
+            build_system_message(config),
+            *(history or []),
+            {"role": "user", "content": user_input},
+        ],
+        **get_model_config(config),
+        "stream": stream,
+        # Ask OpenRouter to report token usage, including on streams
+        "usage": {"include": True},
+    }
 
-@app.command
-def scripts():
-    """Lists all available scripts in the `~/.p90/scripts/` directory."""
-    SCRIPTS_DIR.mkdir(parents=True, exist_ok=True)
-    scripts = list(SCRIPTS_DIR.glob("*.py"))
 
-    if not scripts:
-        console.print("[yellow]No scripts found[/yellow]")
-        return
+def start_request_metrics(payload: Dict[str, Any], body: bytes) -> RequestMetrics:
+    """Start metrics for a request about to be sent."""
+    return RequestMetrics(
+        model=payload.get("model", ""),
+        timestamp=time.time(),
+        request_bytes=len(body),
+        estimated_prompt_tokens=sum(
+            estimate_tokens(message_text(message)) for message in payload["messages"]
+        ),
+    )
 
-    table = Table(title="Available Scripts")
-    table.add_column("Name", style="cyan")
-    table.add_column("Size", style="magenta")
-    table.add_column("Modified", style="green")
 
-    for script in sorted(scripts):
-        stat = script.stat()
-        table.add_row(
-            script.name,
-            f"{stat.st_size} bytes",
-            datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M"),
+def trace_request(metrics: RequestMetrics, start: float):
+    """Build an httpx trace callback that records connection phase timings."""
+    phases = {
+        "connection.connect_tcp": "connect_ms",
+        "connection.start_tls": "tls_ms",
+    }
+    started: Dict[str, float] = {}
+
+    async def trace(event_name: str, info: Dict[str, Any]):
+        now = time.perf_counter()
+        phase, _, stage = event_name.rpartition(".")
+        if stage == "started":
+            started[phase] = now
+        elif stage == "complete" and phase in phases and phase in started:
+            setattr(metrics, phases[phase], (now - started[phase]) * 1000)
+        elif stage == "complete" and phase.endswith(".receive_response_headers"):
+            metrics.ttfb_ms = (now - start) * 1000
+
+    return trace
+
+
+def record_usage(metrics: RequestMetrics, usage: Optional[Dict[str, Any]]):
+    """Copy token counts from an OpenRouter `usage` object."""
+    if usage:
+        metrics.prompt_tokens = usage.get("prompt_tokens")
+        metrics.completion_tokens = usage.get("completion_tokens")
+        details = usage.get("prompt_tokens_details") or {}
+        metrics.cached_tokens = details.get("cached_tokens")
+
+
+def record_request_metrics(metrics: RequestMetrics):
+    """Append request metrics to the metrics log and latency sketches."""
+    record_metrics(REQUEST_METRICS_PATH, asdict(metrics))
+    if metrics.error is None:
+        latencies = {
+            "ttfb_ms": metrics.ttfb_ms,
+            "first_token_ms": metrics.first_token_ms,
+            "total_ms": metrics.total_ms,
+        }
+        update_sketches({f"request:{metrics.model}": latencies})
+    elif metrics.error == "cancelled" and metrics.hedged:
+        # A hedge loser got its first token no sooner than this. Leaving it out
+        # would drop the slow requests and keep shrinking the hedge delay.
+        first_token_ms = metrics.first_token_ms or metrics.total_ms
+        update_sketches(
+            {f"request:{metrics.model}": {"first_token_ms": first_token_ms}}
         )
 
-    console.print(table)
-
-
-@app.command
-def delete(script_name: str):
-    """Deletes the script with the given name from the `~/.p90/scripts/` directory."""
-    if not script_name.endswith(".py"):
-        script_name += ".py"
-
-    script_path = SCRIPTS_DIR / script_name
 
-    if not script_path.exists():
-        print(f"Script '{script_name}' does not exist in ~/.p90/scripts/")
-        return
+def record_metrics(path: Path, record: Dict[str, Any]):
+    """Append a record to a metrics log, rotating it when it grows too large."""
+    try:
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        if path.exists() and path.stat().st_size > METRICS_MAX_BYTES:
+            for index in range(METRICS_BACKUPS - 1, 0, -1):
+                older = path.with_name(f"{path.name}.{index}")
+                if older.exists():
+                    os.replace(older, path.with_name(f"{path.name}.{index + 1}"))
+            os.replace(path, path.with_name(f"{path.name}.1"))
+
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError:
+        # Metrics are best effort and must never fail a request
+        pass
+
+
+def load_sketches() -> Dict[str, Dict[str, QuantileSketch]]:
+    """Load persisted sketches, keyed by group then metric."""
+    try:
+        data = load_json(SKETCHES_PATH)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+    return {
+        group: {
+            metric: QuantileSketch.from_dict(buckets)
+            for metric, buckets in metrics.items()
+        }
+        for group, metrics in data.items()
+    }
 
-    script_path.unlink()
-    print(f"Successfully deleted script '{script_name}'")
 
+def update_sketches(values: Dict[str, Dict[str, Optional[float]]]):
+    """Add values to the persisted sketches, keyed by group then metric.
 
-# ===== HELPER FUNCTIONS =====
+    The daemon and CLI processes update the file concurrently, so the
+    read-modify-write happens under a lock file.
+    """
+    try:
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        with open(SKETCHES_LOCK_PATH, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                sketches = load_sketches()
+                for group, metrics in values.items():
+                    for metric, value in metrics.items():
+                        if value is not None:
+                            sketches.setdefault(group, {}).setdefault(
+                                metric, QuantileSketch()
+                            ).add(value)
+
+                temp_path = SKETCHES_PATH.with_suffix(f".{os.getpid()}.tmp")
+                with open(temp_path, "w") as f:
+                    json.dump(
+                        {
+                            group: {
+                                metric: sketch.to_dict()
+                                for metric, sketch in metrics.items()
+                            }
+                            for group, metrics in sketches.items()
+                        },
+                        f,
+                    )
+                os.replace(temp_path, SKETCHES_PATH)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+    except OSError:
+        pass
+
+
+def record_run_metrics(
+    phases: Dict[str, float], model: str, response_type: str, cached: bool
+):
+    """Record phase timings of one `p90` run.
+
+    Cache hits get their own sketch group so they don't drag down the
+    percentiles of runs that actually queried the model.
+    """
+    total_ms = (time.perf_counter() - PROCESS_START) * 1000
+    record_metrics(
+        RUN_METRICS_PATH,
+        {
+            "timestamp": time.time(),
+            "model": model,
+            "response_type": response_type,
+            "cached": cached,
+            "phases": phases,
+            "total_ms": total_ms,
+        },
+    )
+    latencies = {**phases, "total_ms": total_ms}
+    if cached:
+        update_sketches({f"cached:{response_type}": latencies})
+    else:
+        update_sketches(
+            {f"model:{model}": latencies, f"type:{response_type}": latencies}
+        )
 
 
-def ensure_config_exists():
-    """Ensure config directory and files exist, recreating from defaults if needed."""
-    USER_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+async def call_openrouter_api(
+    user_input: str,
+    config: AppConfig,
+    client: Optional["httpx.AsyncClient"] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> str:
+    """Make API call to OpenRouter."""
+    import asyncio
 
-    # Handle config.json
-    if not CONFIG_PATH.exists():
-        try:
-            default_config = json.loads(app_config)
-            save_json(CONFIG_PATH, default_config)
-        except Exception as e:
-            print(f"Failed to create config from defaults: {e}")
-            raise SystemExit(1)
+    payload = build_payload(user_input, config, history=history)
+    body = json.dumps(payload).encode()
+    metrics = start_request_metrics(payload, body)
+    await get_rate_limiter(config).acquire(
+        metrics.estimated_prompt_tokens + (payload.get("max_tokens") or 0)
+    )
+    timeouts = get_timeouts(config)
+    start = time.perf_counter()
+    try:
+        # The body only arrives once generation finishes, so only the connect
+        # and total limits apply here
+        response = await wait_with_timeout(
+            (client or get_http_client()).post(
+                OPENROUTER_API_URL,
+                headers=get_api_headers(config),
+                content=body,
+                timeout=get_httpx_timeout(timeouts),
+                extensions={"trace": trace_request(metrics, start)},
+            ),
+            timeouts["total"],
+            f"OpenRouter did not respond within {timeouts['total']}s",
+        )
+        response.raise_for_status()
+        data = response.json()
+        record_usage(metrics, data.get("usage"))
+        return data["choices"][0]["message"]["content"]
+    except asyncio.CancelledError:
+        # Losing a race or hedge is not a failure of the model
+        metrics.error = "cancelled"
+        raise
+    except Exception as e:
+        metrics.error = str(e)
+        raise
+    finally:
+        metrics.total_ms = (time.perf_counter() - start) * 1000
+        record_request_metrics(metrics)
+
+
+async def stream_openrouter_api(
+    user_input: str,
+    config: AppConfig,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> AsyncIterator[str]:
+    """Make a streaming API call to OpenRouter, yielding text as it arrives.
+
+    A stream that is still producing data may run up to the total timeout, but
+    fails fast if the first token or any further data takes too long.
+    """
+    import asyncio
+
+    payload = build_payload(user_input, config, stream=True, history=history)
+    body = json.dumps(payload).encode()
+    metrics = start_request_metrics(payload, body)
+    metrics.hedged = hedging.get()
+    await get_rate_limiter(config).acquire(
+        metrics.estimated_prompt_tokens + (payload.get("max_tokens") or 0)
+    )
+    timeouts = get_timeouts(config)
+    start = time.monotonic()
+    total_deadline = start + timeouts["total"]
+    first_token_deadline = start + timeouts["first_byte"]
+
+    def next_timeout() -> Tuple[float, str]:
+        """Seconds until the nearest deadline, and the message if it passes."""
+        now = time.monotonic()
+        limits = [
+            (
+                total_deadline - now,
+                f"OpenRouter response exceeded {timeouts['total']}s",
+            )
+        ]
+        # Until the first token the wait is bounded by `first_byte` alone, so a
+        # model that thinks for a while is not cut off by the idle timeout
+        if metrics.first_token_ms is None:
+            limits.append(
+                (
+                    first_token_deadline - now,
+                    f"No response from OpenRouter within {timeouts['first_byte']}s",
+                )
+            )
+        else:
+            limits.append(
+                (timeouts["idle"], f"No data from OpenRouter for {timeouts['idle']}s")
+            )
+        return min(limits)
 
-    # Handle system_prompt.md
-    if not SYSTEM_PROMPT_PATH.exists():
+    try:
+        client = get_http_client()
+        request = client.build_request(
+            "POST",
+            OPENROUTER_API_URL,
+            headers=get_api_headers(config),
+            content=body,
+            timeout=get_httpx_timeout(timeouts),
+            extensions={"trace": trace_request(metrics, time.perf_counter())},
+        )
+        response = await wait_with_timeout(
+            client.send(request, stream=True), *next_timeout()
+        )
         try:
-            with open(SYSTEM_PROMPT_PATH, "w") as f:
-                f.write(app_system_prompt)
-        except Exception as e:
-            print(f"Failed to create system prompt from defaults: {e}")
-            raise SystemExit(1)
+            response.raise_for_status()
+            lines = response.aiter_lines()
+            while True:
+                try:
+                    line = await wait_with_timeout(anext(lines), *next_timeout())
+                except StopAsyncIteration:
+                    break
+
+                # Skip blank separators and SSE comments (": OPENROUTER PROCESSING")
+                if not line.startswith("data:"):
+                    continue
+
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"].get("message", chunk["error"]))
+
+                # The final chunk carries token usage for the whole stream
+                record_usage(metrics, chunk.get("usage"))
+
+                choices = chunk.get("choices") or [{}]
+                content = choices[0].get("delta", {}).get("content")
+                if content:
+                    if metrics.first_token_ms is None:
+                        metrics.first_token_ms = (time.monotonic() - start) * 1000
+                    yield content
+        finally:
+            await response.aclose()
+    except asyncio.CancelledError:
+        # Losing a race or hedge is not a failure of the model
+        metrics.error = "cancelled"
+        raise
+    except Exception as e:
+        metrics.error = str(e)
+        raise
+    finally:
+        metrics.total_ms = (time.monotonic() - start) * 1000
+        record_request_metrics(metrics)
 
 
-def load_json(path: Path) -> Dict[str, Any]:
-    """Load JSON file."""
-    with open(path) as f:
-        return json.load(f)
+def get_timeouts(config: AppConfig) -> Dict[str, float]:
+    """Get request timeouts in seconds, with defaults for any not configured."""
+    return {**DEFAULT_TIMEOUTS, **(config.client_config.get("timeouts") or {})}
 
 
-def save_json(path: Path, data: Dict[str, Any]):
-    """Save JSON file."""
-    with open(path, "w") as f:
-        json.dump(data, f, indent=4)
+def get_httpx_timeout(timeouts: Dict[str, float]) -> "httpx.Timeout":
+    """httpx timeout that bounds connection setup; reads are bounded by the caller."""
+    import httpx
 
+    return httpx.Timeout(
+        timeouts["total"], connect=timeouts["connect"], pool=timeouts["connect"]
+    )
 
-def get_editor() -> str:
-    """Get the user's preferred editor."""
-    return os.environ.get("EDITOR", "nano")
 
+async def wait_with_timeout(awaitable, timeout: float, message: str):
+    """Await with a timeout, raising an httpx timeout so it is retried like one."""
+    import asyncio
+    import httpx
 
-def get_api_headers() -> Optional[Dict[str, str]]:
-    """Get OpenRouter API headers."""
     try:
-        ensure_config_exists()
-        config = load_json(CONFIG_PATH)
-        api_key = config.get("openrouter_api_key")
-        if not api_key:
-            return None
-
-        return {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        }
-    except (json.JSONDecodeError, IOError) as e:
-        print(f"Failed to read config: {e}")
-        raise SystemExit(1)
+        return await asyncio.wait_for(awaitable, max(0.0, timeout))
+    except TimeoutError:
+        raise httpx.ReadTimeout(message) from None
 
 
-def get_system_prompt() -> str:
-    """Get system prompt with hydrated variables."""
-    try:
-        ensure_config_exists()
-        with open(SYSTEM_PROMPT_PATH) as f:
-            content = f.read()
-    except (IOError, OSError) as e:
-        print(f"Failed to read system prompt: {e}")
-        raise SystemExit(1)
+_rate_limiters: Dict[Tuple[float, float, bool], RateLimiter] = {}
 
-    # Hydrate variables
-    replacements = {
-        "${{OS}}": os.name,
-        "${{CWD}}": os.getcwd(),
-        "${{DATE}}": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "${{SHELL}}": os.environ.get("SHELL", "unknown"),
-    }
 
-    for old, new in replacements.items():
-        content = content.replace(old, new)
+def get_rate_limiter(config: AppConfig) -> RateLimiter:
+    """Get the process-wide rate limiter for the configured limits."""
+    key = (
+        config.client_config.get("rate_limit_rpm", 0),
+        config.client_config.get("rate_limit_tpm", 0),
+        config.client_config.get("rate_limit_shared", False),
+    )
+    if key not in _rate_limiters:
+        _rate_limiters[key] = RateLimiter(*key)
+    return _rate_limiters[key]
+
+
+def classify_error(error: Exception) -> str:
+    """Classify a request error into one of the RETRY_POLICIES classes."""
+    import httpx
+
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        if status == 429:
+            return "rate_limit"
+        if status in (401, 402, 403):
+            return "auth"
+        if status >= 500:
+            return "server"
+        return "client"
+    if isinstance(error, httpx.TransportError):
+        # Timeouts, refused connections and dropped streams
+        return "network"
+    # Errors reported by the provider inside a stream
+    return "server" if isinstance(error, RuntimeError) else "client"
+
+
+def get_retry_delay(
+    error: Exception, attempt: int, config: AppConfig
+) -> Optional[float]:
+    """Seconds to wait before retrying after error, or None to stop retrying this model.
+
+    Uses exponential backoff with full jitter, honoring a Retry-After header.
+    """
+    import email.utils
+
+    policy = RETRY_POLICIES[classify_error(error)]
+    retries = min(policy["retries"], config.client_config.get("max_retries", 4))
+    if attempt >= retries:
+        return None
+
+    retry_after = getattr(getattr(error, "response", None), "headers", {}).get(
+        "retry-after"
+    )
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX_DELAY)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after).timestamp()
+                return min(max(0.0, retry_at - time.time()), RETRY_MAX_DELAY)
+            except (TypeError, ValueError):
+                pass
+
+    return random.uniform(0, min(policy["base_delay"] * 2**attempt, RETRY_MAX_DELAY))
+
+
+def get_fallback_configs(config: AppConfig) -> List[AppConfig]:
+    """The configured model followed by any fallback models, in order."""
+    return [config] + [
+        with_model(config, model)
+        for model in config.client_config.get("fallback_models") or []
+    ]
 
-    return content
 
+async def request_completion(
+    user_input: str,
+    config: AppConfig,
+    client: Optional["httpx.AsyncClient"] = None,
+    history: Optional[List[Dict[str, str]]] = None,
+    fallback: bool = True,
+) -> str:
+    """Make API call to OpenRouter, retrying transient errors and falling back to other models.
+
+    With `fallback` off only the configured model is tried.
+    """
+    import asyncio
+
+    error: Optional[Exception] = None
+    for model_config in get_fallback_configs(config) if fallback else [config]:
+        attempt = 0
+        while True:
+            try:
+                return await call_openrouter_api(
+                    user_input, model_config, client, history
+                )
+            except Exception as e:
+                error = e
+                delay = get_retry_delay(e, attempt, config)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+                attempt += 1
+
+        if not RETRY_POLICIES[classify_error(error)]["fallback"]:
+            break
+
+    raise error
+
+
+async def stream_completion(
+    user_input: str,
+    config: AppConfig,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> AsyncIterator[str]:
+    """Streaming counterpart of `request_completion`.
+
+    A request is only retried if it failed before yielding any text, so output
+    is never duplicated.
+    """
+    import asyncio
+
+    error: Optional[Exception] = None
+    for model_config in get_fallback_configs(config):
+        attempt = 0
+        while True:
+            started = False
+            try:
+                async for chunk in stream_openrouter_api(
+                    user_input, model_config, history
+                ):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started:
+                    raise
+                error = e
+                delay = get_retry_delay(e, attempt, config)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+                attempt += 1
+
+        if not RETRY_POLICIES[classify_error(error)]["fallback"]:
+            break
+
+    raise error
+
+
+def parse_batch_line(line: str) -> str:
+    """Get the prompt from a batch input line (plain text or JSON object)."""
+    line = line.strip()
+    if line.startswith("{"):
+        return json.loads(line)["prompt"]
+    return line
+
+
+async def run_batch(prompts: List[str], config: AppConfig, concurrency: int, out):
+    """Run prompts concurrently, writing JSONL results to out in input order."""
+    import asyncio
+
+    semaphore = asyncio.Semaphore(concurrency)
+    request_prompt_variables.set(await evaluate_prompt_variables(config))
+
+    async def run_one(client: "httpx.AsyncClient", prompt: str) -> Dict[str, Any]:
+        response, _ = lookup_cached_response(prompt, config)
+        if response is None:
+            try:
+                async with semaphore:
+                    response = await request_completion(prompt, config, client)
+            except Exception as e:
+                return {"prompt": prompt, "error": str(e)}
+            store_cached_response(prompt, response, config)
+
+        return {"prompt": prompt, **asdict(parse_model_response(response))}
+
+    async with create_async_http_client(concurrency) as client:
+        tasks = [asyncio.create_task(run_one(client, prompt)) for prompt in prompts]
+        # Awaiting in order streams results out as soon as each prefix is done
+        for task in tasks:
+            out.write(json.dumps(await task) + "\n")
+            out.flush()
+
+
+async def render_stream(
+    chunks: AsyncIterable[str],
+) -> Tuple[str, Optional[Tuple[str, str]]]:
+    """Render the response envelope as it streams in.
+
+    <response> text is rendered live, <cli> commands are previewed and
+    <python-script> bodies are written to a temporary file in the scripts
+    directory as they arrive and only replace the named script once complete.
+    Returns the full response text and the (envelope type, script name) that
+    was already handled, or None when nothing was.
+    """
+    from rich.live import Live
+    from rich.markdown import Markdown
+
+    parser = StreamParser()
+    text = ""
+    live = None
+    body = ""
+    script_file = None
+    script_name = ""
+    script_path = None
+    temp_path = None
+    pending_whitespace = ""
+    last_render = 0.0
+
+    def render(final: bool = False):
+        nonlocal last_render
+        now = time.monotonic()
+        if final or now - last_render >= STREAM_RENDER_INTERVAL:
+            if parser.response_type == "response":
+                live.update(Markdown(body.strip()))
+            else:
+                live.update(f"[dim]Generating command: {body.strip()}[/dim]")
+            live.refresh()
+            last_render = now
 
-def get_model_config() -> Dict[str, Any]:
-    """Get model configuration without API key."""
     try:
-        ensure_config_exists()
-        config = load_json(CONFIG_PATH)
-        config.pop("openrouter_api_key", None)
-        return config
-    except Exception as e:
-        print(f"Failed to read model config: {e}")
-        raise SystemExit(1)
-
+        async for chunk in chunks:
+            text += chunk
+            for event in parser.feed(chunk):
+                if (
+                    event.kind == "open"
+                    and event.text in ("response", "cli")
+                    and get_console().is_terminal
+                ):
+                    live = Live(
+                        console=get_console(),
+                        auto_refresh=False,
+                        transient=event.text == "cli",
+                    )
+                    live.start()
+                elif event.kind == "name":
+                    SCRIPTS_DIR.mkdir(parents=True, exist_ok=True)
+                    script_name = event.text
+                    script_path = SCRIPTS_DIR / script_name
+                    temp_path = SCRIPTS_DIR / f".{event.text}.{os.getpid()}.tmp"
+                    script_file = open(temp_path, "w")
+                elif event.kind == "body" and script_file is not None:
+                    # Hold back trailing whitespace so the saved script is stripped
+                    chunk_body = pending_whitespace + event.text
+                    stripped = chunk_body.rstrip()
+                    pending_whitespace = chunk_body[len(stripped) :]
+                    script_file.write(stripped)
+                elif event.kind == "body" and live is not None:
+                    body += event.text
+                    render()
+
+        if live is not None:
+            render(final=True)
+    finally:
+        if live is not None:
+            live.stop()
+        if script_file is not None:
+            script_file.close()
+            # A script cut off mid-stream is unusable; keep any earlier version
+            if parser.complete:
+                os.replace(temp_path, script_path)
+            else:
+                temp_path.unlink(missing_ok=True)
+
+    if parser.response_type == "python-script":
+        return text, ("python-script", script_name) if parser.complete else None
+    return text, (parser.response_type, "") if live is not None else None
+
+
+def was_rendered(parsed: ParsedResponse, handled: Optional[Tuple[str, str]]) -> bool:
+    """Whether the envelope handled while streaming is the one that was parsed."""
+    return handled == (parsed.response_type, parsed.script_name)
 
-def get_user_input(args) -> Optional[str]:
-    """Get user input from args or editor."""
-    if args:
-        return " ".join(args)
 
-    with tempfile.NamedTemporaryFile(mode="w+", suffix=".txt", delete=False) as f:
-        temp_path = f.name
+@dataclass
+class StreamEvent:
+    kind: str  # "open", "name", "body" or "close"
+    text: str = ""
 
-    subprocess.run([get_editor(), temp_path])
 
-    with open(temp_path) as f:
-        user_input = f.read().strip()
+class StreamParser:
+    """Incremental parser for the XML response envelope.
 
-    os.unlink(temp_path)
-    return user_input if user_input else None
+    Chunks are pushed in with `feed`, which returns the events that became
+    known: the envelope type as soon as its opening tag arrives, then body
+    text, then the close. Text that could still be the start of a tag is held
+    back until the next chunk disambiguates it.
+    """
 
+    ENVELOPES = ("response", "cli", "python-script")
 
-def call_openrouter_api(user_input: str) -> str:
-    """Make API call to OpenRouter."""
-    payload = {
-        "messages": [
-            {"role": "system", "content": get_system_prompt()},
-            {"role": "user", "content": user_input},
-        ],
-        **get_model_config(),
-    }
+    def __init__(self):
+        self.buffer = ""
+        self.response_type: Optional[str] = None
+        self.state = "envelope"
+        self.complete = False
+        self.body_started = False
 
-    response = httpx.post(
-        OPENROUTER_API_URL,
-        headers=get_api_headers(),
-        json=payload,
-        timeout=40,
-    )
-    response.raise_for_status()
-    return response.json()["choices"][0]["message"]["content"]
+    def feed(self, chunk: str) -> List[StreamEvent]:
+        self.buffer += chunk
+        events: List[StreamEvent] = []
+        while self._step(events):
+            pass
+        return events
+
+    def _step(self, events: List[StreamEvent]) -> bool:
+        """Advance the state machine once, returning whether progress was made."""
+        if self.state == "envelope":
+            # The first opening tag wins; later ones are part of its body
+            found = [
+                (index, name)
+                for name in self.ENVELOPES
+                if (index := self.buffer.find(f"<{name}>")) != -1
+            ]
+            if found:
+                index, name = min(found)
+                self.response_type = name
+                self.buffer = self.buffer[index + len(name) + 2 :]
+                self.state = "script-name" if name == "python-script" else "body"
+                events.append(StreamEvent("open", name))
+                return True
+            # Only the tail could still begin an opening tag
+            self.buffer = self.buffer[-len("<python-script>") :]
+            return False
+
+        if self.state == "script-name":
+            match = re.search(
+                r"<script-name>(.*?)</script-name>", self.buffer, re.DOTALL
+            )
+            if not match:
+                return False
+            events.append(StreamEvent("name", match.group(1).strip()))
+            self.buffer = self.buffer[match.end() :]
+            self.state = "script-body"
+            return True
+
+        if self.state == "script-body":
+            index = self.buffer.find("<script-body>")
+            if index == -1:
+                return False
+            self.buffer = self.buffer[index + len("<script-body>") :]
+            self.state = "body"
+            return True
+
+        if self.state == "body":
+            close_tag = (
+                "</script-body>"
+                if self.response_type == "python-script"
+                else f"</{self.response_type}>"
+            )
+            index = self.buffer.find(close_tag)
+            if index != -1:
+                self._emit_body(self.buffer[:index], events)
+                self.buffer = self.buffer[index + len(close_tag) :]
+                if self.response_type == "python-script":
+                    self.state = "script-close"
+                    return True
+                self._close(events)
+                return False
+
+            held = partial_suffix_length(self.buffer, close_tag)
+            self._emit_body(self.buffer[: len(self.buffer) - held], events)
+            self.buffer = self.buffer[len(self.buffer) - held :]
+            return False
+
+        if self.state == "script-close":
+            # A script is only complete once the whole envelope has arrived
+            if "</python-script>" not in self.buffer:
+                return False
+            self._close(events)
+            return False
+
+        return False
+
+    def _close(self, events: List[StreamEvent]):
+        self.buffer = ""
+        self.state = "done"
+        self.complete = True
+        events.append(StreamEvent("close", self.response_type))
+
+    def _emit_body(self, text: str, events: List[StreamEvent]):
+        if not self.body_started:
+            text = text.lstrip()
+            self.body_started = bool(text)
+        if text:
+            events.append(StreamEvent("body", text))
+
+
+def partial_suffix_length(text: str, tag: str) -> int:
+    """Length of the longest suffix of text that is a proper prefix of tag."""
+    for length in range(min(len(text), len(tag) - 1), 0, -1):
+        if tag.startswith(text[-length:]):
+            return length
+    return 0
 
 
 def parse_model_response(response: str) -> ParsedResponse:
-    """Parse model response based on XML format."""
-    patterns = [
-        (
-            r"<response>(.*?)</response>",
-            lambda m: ParsedResponse("response", m.group(1).strip()),
-        ),
-        (r"<cli>(.*?)</cli>", lambda m: ParsedResponse("cli", m.group(1).strip())),
-    ]
-
-    for pattern, handler in patterns:
-        match = re.search(pattern, response, re.DOTALL)
+    """Parse model response based on XML format.
+
+    The envelope that opens first wins, so tags quoted inside a body are kept
+    as body text.
+    """
+    candidates = []
+    for name in ("response", "cli"):
+        match = re.search(rf"<{name}>(.*?)</{name}>", response, re.DOTALL)
         if match:
-            return handler(match)
+            candidates.append(
+                (match.start(), ParsedResponse(name, match.group(1).strip()))
+            )
 
     # Handle python-script format
     script_match = re.search(
@@ -311,28 +2985,368 @@ def parse_model_response(response: str) -> ParsedResponse:
         body_match = re.search(r"<script-body>(.*?)</script-body>", content, re.DOTALL)
 
         if name_match and body_match:
-            return ParsedResponse(
-                "python-script",
-                script_name=name_match.group(1).strip(),
-                script_body=body_match.group(1).strip(),
+            candidates.append(
+                (
+                    script_match.start(),
+                    ParsedResponse(
+                        "python-script",
+                        script_name=name_match.group(1).strip(),
+                        script_body=body_match.group(1).strip(),
+                    ),
+                )
             )
 
+    if candidates:
+        return min(candidates, key=lambda candidate: candidate[0])[1]
     return ParsedResponse("response", response)
 
 
-def execute_command(command: str):
-    """Execute a shell command and display output."""
-    print(f"Executing: {command}")
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
-    if result.stdout:
-        print(result.stdout)
-    if result.stderr:
-        console.print(f"[red]{result.stderr}[/red]")
+def parse_importtime(output: str) -> List[Tuple[str, int, int]]:
+    """Parse `-X importtime` output into (module, self us, cumulative us) rows.
+
+    Module names keep their indentation, which encodes import nesting.
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|", 2)
+        # Drop the single separator space after the column bar
+        imports.append((name[1:].rstrip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def is_well_formed(response: str) -> bool:
+    """Whether the response contains a complete response envelope."""
+    return any(
+        re.search(pattern, response, re.DOTALL)
+        for pattern in (
+            r"<response>.*?</response>",
+            r"<cli>.*?</cli>",
+            r"<python-script>.*?<script-name>.*?</script-name>.*?"
+            r"<script-body>.*?</script-body>.*?</python-script>",
+        )
+    )
+
+
+def get_cache_context(config: AppConfig) -> str:
+    """Hash the hydrated system prompt and model config that a cached answer depends on.
+
+    Volatile variables such as the date are left unhydrated so that repeat
+    queries can hit.
+    """
+    template = compile_prompt(config.system_prompt)
+    names = [
+        name for name in template.variables if name not in VOLATILE_PROMPT_VARIABLES
+    ]
+    context = json.dumps(
+        [
+            template.render(get_prompt_variables(names, config)),
+            get_model_config(config),
+        ],
+        sort_keys=True,
+    )
+    return hashlib.sha256(context.encode()).hexdigest()
+
+
+def lookup_cached_response(
+    user_input: str, config: AppConfig
+) -> Tuple[Optional[str], Optional[str]]:
+    """Look up a response in the exact and near-duplicate caches.
+
+    Returns the response and a notice describing where it came from, or
+    (None, None) on a miss.
+    """
+    cache_key = get_cache_key(user_input, config)
+    if cache_key is None:
+        return None, None
+
+    response = read_cached_response(cache_key, config)
+    if response is not None:
+        return response, "Served from cache"
+
+    similar = find_similar_response(user_input, config)
+    if similar is not None:
+        return similar[0], f"Served from cache (similar query, {similar[1]:.0%} match)"
+
+    return None, None
+
+
+def store_cached_response(user_input: str, response: str, config: AppConfig):
+    """Store a fresh well-formed response in both cache tiers."""
+    cache_key = get_cache_key(user_input, config)
+    if cache_key and is_well_formed(response):
+        write_cached_response(cache_key, response, config)
+        add_similar_response(user_input, response, config)
+
+
+def get_cache_key(user_input: str, config: AppConfig) -> Optional[str]:
+    """Hash the cache context and user input into a cache key.
+
+    Returns None when the cache is disabled.
+    """
+    if not config.client_config.get("cache_ttl_seconds", CACHE_TTL_SECONDS):
+        return None
+
+    key_data = f"{get_cache_context(config)}\0{user_input}"
+    return hashlib.sha256(key_data.encode()).hexdigest()
+
+
+def read_cached_response(key: str, config: AppConfig) -> Optional[str]:
+    """Return the cached response for key if present and not expired."""
+    path = RESPONSE_CACHE_DIR / f"{key}.json"
+    try:
+        entry = load_json(path)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    ttl = config.client_config.get("cache_ttl_seconds", CACHE_TTL_SECONDS)
+    if time.time() - entry.get("created", 0) > ttl:
+        path.unlink(missing_ok=True)
+        return None
+
+    # The file mtime doubles as the last-used time for LRU eviction
+    os.utime(path)
+    return entry.get("response")
+
+
+def write_cached_response(key: str, response: str, config: AppConfig):
+    """Store a response in the cache, evicting least recently used entries over the size limit."""
+    try:
+        RESPONSE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        path = RESPONSE_CACHE_DIR / f"{key}.json"
+        temp_path = path.with_suffix(".tmp")
+        save_json(temp_path, {"created": time.time(), "response": response})
+        os.replace(temp_path, path)
+
+        max_bytes = config.client_config.get("cache_max_mb", CACHE_MAX_MB) * 1024 * 1024
+        entries = []
+        for entry_path in RESPONSE_CACHE_DIR.glob("*.json"):
+            stat = entry_path.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total <= max_bytes:
+                break
+            entry_path.unlink(missing_ok=True)
+            total -= size
+    except OSError as e:
+        # A broken cache should never fail the request itself
+        get_console().print(f"[yellow]Failed to write response cache: {e}[/yellow]")
+
+
+def normalize_query(text: str) -> str:
+    """Normalize a query for near-duplicate matching (case, punctuation, stop words)."""
+    words = re.findall(r"[\w./-]+", text.lower())
+    return " ".join(word for word in words if word not in STOP_WORDS)
+
+
+def exact_query_terms(text: str) -> List[str]:
+    """Terms that must match exactly for a near-duplicate hit: anything with a digit or path characters."""
+    return sorted(
+        term
+        for term in re.findall(r"[\w./~\\-]+", text.lower())
+        if re.search(r"[\d./~\\]", term)
+    )
+
+
+@functools.cache
+def minhash_parameters() -> List[Tuple[int, int]]:
+    """Fixed (a, b) coefficients for the MinHash permutations."""
+    rng = random.Random(90)
+    return [
+        (rng.randrange(1, 2**32) | 1, rng.randrange(2**32))
+        for _ in range(MINHASH_PERMUTATIONS)
+    ]
+
+
+def minhash_signature(text: str) -> List[int]:
+    """MinHash signature over the character n-grams of text."""
+    text = f" {text} "
+    shingles = {
+        int.from_bytes(
+            hashlib.blake2b(text[i : i + SHINGLE_SIZE].encode(), digest_size=4).digest()
+        )
+        for i in range(max(1, len(text) - SHINGLE_SIZE + 1))
+    }
+    return [
+        min(((a * shingle + b) & 0xFFFFFFFF) for shingle in shingles)
+        for a, b in minhash_parameters()
+    ]
+
+
+def find_similar_response(
+    user_input: str, config: AppConfig
+) -> Optional[Tuple[str, float]]:
+    """Find a cached response to a near-identical query.
+
+    Returns the response and the estimated similarity, or None when the tier is
+    disabled or nothing clears the threshold.
+    """
+    if not config.client_config.get("similar_cache", False):
+        return None
+
+    try:
+        with (
+            open(SIMILAR_INDEX_PATH, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index,
+        ):
+            context = bytes.fromhex(get_cache_context(config))[:8]
+            signature = minhash_signature(normalize_query(user_input))
+            threshold = config.client_config.get(
+                "similar_cache_threshold", SIMILAR_CACHE_THRESHOLD
+            )
+
+            best_slot, best_score = None, threshold
+            for slot, offset in enumerate(
+                range(SIMILAR_INDEX_HEADER.size, len(index), SIMILAR_INDEX_RECORD.size)
+            ):
+                if index[offset : offset + 8] != context:
+                    continue
+                record = SIMILAR_INDEX_RECORD.unpack_from(index, offset)
+                matches = sum(x == y for x, y in zip(signature, record[1:]))
+                score = matches / MINHASH_PERMUTATIONS
+                if score >= best_score:
+                    best_slot, best_score = slot, score
+    except (FileNotFoundError, ValueError):
+        # ValueError: mmap of an empty file
+        return None
+
+    if best_slot is None:
+        return None
+
+    try:
+        entry = load_json(SIMILAR_CACHE_DIR / f"{best_slot}.json")
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    ttl = config.client_config.get("cache_ttl_seconds", CACHE_TTL_SECONDS)
+    if time.time() - entry.get("created", 0) > ttl:
+        return None
+
+    # Numbers, paths and extensions decide what a command does, so "files older
+    # than 7 days" must not be answered with the command for 70 days
+    if exact_query_terms(entry.get("query", "")) != exact_query_terms(user_input):
+        return None
+
+    response = entry.get("response")
+    # Only plain answers are reused; a command or script for a merely similar
+    # question would run without anyone checking it
+    if response is None or parse_model_response(response).response_type != "response":
+        return None
+
+    return response, best_score
+
+
+def add_similar_response(user_input: str, response: str, config: AppConfig):
+    """Add a query and its plain-text response to the near-duplicate index."""
+    if not config.client_config.get("similar_cache", False):
+        return
+    if parse_model_response(response).response_type != "response":
+        return
+
+    max_entries = config.client_config.get(
+        "similar_cache_max_entries", SIMILAR_CACHE_MAX_ENTRIES
+    )
+    try:
+        SIMILAR_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        if not SIMILAR_INDEX_PATH.exists():
+            SIMILAR_INDEX_PATH.write_bytes(SIMILAR_INDEX_HEADER.pack(0))
+
+        with open(SIMILAR_INDEX_PATH, "r+b") as f:
+            (written,) = SIMILAR_INDEX_HEADER.unpack(f.read(SIMILAR_INDEX_HEADER.size))
+            # Ring buffer: once full, the oldest slot is overwritten
+            slot = written % max_entries
+
+            save_json(
+                SIMILAR_CACHE_DIR / f"{slot}.json",
+                {"created": time.time(), "query": user_input, "response": response},
+            )
+
+            f.seek(SIMILAR_INDEX_HEADER.size + slot * SIMILAR_INDEX_RECORD.size)
+            f.write(
+                SIMILAR_INDEX_RECORD.pack(
+                    bytes.fromhex(get_cache_context(config))[:8],
+                    *minhash_signature(normalize_query(user_input)),
+                )
+            )
+            f.seek(0)
+            f.write(SIMILAR_INDEX_HEADER.pack(written + 1))
+    except OSError as e:
+        get_console().print(
+            f"[yellow]Failed to update similar query index: {e}[/yellow]"
+        )
+
+
+async def execute_command(command: str, tee: Optional[Path] = None) -> int:
+    """Execute a shell command, streaming its output as it is produced.
+
+    Output is forwarded in fixed-size chunks so memory stays bounded no matter
+    how much the command prints. stderr is shown in red. Returns the exit code.
+    The command isn't started if the tee file can't be opened.
+    """
+    import asyncio
+
+    try:
+        tee_file = open(tee, "ab") if tee else None
+    except OSError as e:
+        get_console().print(f"[red]Failed to open {tee}: {e}[/red]")
+        return 1
+
+    async def forward(stream: "asyncio.StreamReader", is_stderr: bool):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while chunk := await stream.read(EXECUTE_CHUNK_SIZE):
+            if tee_file is not None:
+                tee_file.write(chunk)
+            text = decoder.decode(chunk)
+            if is_stderr:
+                # soft_wrap keeps rich from hard-wrapping at the console width
+                get_console().print(
+                    text,
+                    style="red",
+                    end="",
+                    markup=False,
+                    highlight=False,
+                    soft_wrap=True,
+                )
+            else:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+
+    print(f"Executing: {command}", flush=True)
+    try:
+        process = await asyncio.create_subprocess_shell(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        await asyncio.gather(
+            forward(process.stdout, False), forward(process.stderr, True)
+        )
+        return await process.wait()
+    finally:
+        if tee_file is not None:
+            tee_file.close()
 
 
 def main():
+    # Plain prompts go to a running daemon when there is one; anything with
+    # options or a subcommand is handled in-process.
+    args = sys.argv[1:]
+    if (
+        args
+        and args[0] not in app
+        and not any(arg.startswith("-") for arg in args)
+        and hasattr(socket, "AF_UNIX")
+        and DAEMON_SOCKET_PATH.exists()
+    ):
+        import asyncio
+
+        if asyncio.run(run_daemon_client(" ".join(args))):
+            return
+
     app()
 
+
 app_config = r"""
 {
     "model": "anthropic/claude-sonnet-4",
@@ -344,6 +3358,7 @@ app_config = r"""
     "repetition_penalty": 1.0,
     "min_p": 0.0,
     "top_a": 0.0,
+    "stream": true,
     "openrouter_api_key": ""
 }
 """
@@ -351,15 +3366,6 @@ app_config = r"""
 app_system_prompt = r"""
 You are an interactive CLI tool that helps users with software engineering tasks. Use the instructions below and to assist the user.
 
-# Context
-
-```handlebars
-OS: ${{OS}}
-CWD: ${{CWD}}
-DATE: ${{DATE}}
-SHELL: ${{SHELL}}
-```
-
 # Instructions
 
 A user may query you to execute a task or ask a question.  
@@ -397,7 +3403,8 @@ Return the result in one, and only one, of the following formats:
 
 - Wrap the CLI line appropriately for a CLI context.
 - You may pipe and chain multiple CLI commands, but keep it as a single CLI command.
-- Only use standard CLI commands that fit the OS and shell context, unless the user has implied a certain command is installed, eg `docker`.
+- Only use standard CLI commands that fit the OS and shell context and the installed TOOLS, unless the user has implied a certain command is installed, eg `docker`.
+- Prefer the fastest installed tools, eg `rg` over `grep -r`, `fd` over `find`, and spread work across CPUs with `parallel` or `xargs -P` when it helps.
 - Ensure proper quoting of inputs.
 
 # python-script Format
@@ -418,6 +3425,19 @@ Return the result in one, and only one, of the following formats:
 
 - The reply should be a single top level element of {response, cli, or python-script} and nothing else.
 - Add no extra helper prose or fluff.
+
+# Context
+
+```handlebars
+OS: ${{OS}}
+CWD: ${{CWD}}
+DATE: ${{DATE}}
+SHELL: ${{SHELL}}
+CPU_COUNT: ${{CPU_COUNT}}
+MEMORY: ${{MEMORY}}
+PYTHON_VERSION: ${{PYTHON_VERSION}}
+TOOLS: ${{TOOLS}}
+```
 """
 
 if __name__ == "__main__":
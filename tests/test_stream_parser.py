@@ -0,0 +1,61 @@
+from p90.__main__ import StreamParser, parse_model_response
+
+SCRIPT = (
+    "<python-script><script-name>demo.py</script-name>"
+    "<script-body>\nprint('<response>hi</response> <cli>ls</cli>')\n</script-body>"
+    "</python-script>"
+)
+
+
+def feed_all(chunks):
+    parser = StreamParser()
+    events = [event for chunk in chunks for event in parser.feed(chunk)]
+    return parser, events
+
+
+def body_text(events):
+    return "".join(event.text for event in events if event.kind == "body")
+
+
+def test_single_chunk_response():
+    parser, events = feed_all(["<response>\nHello **world**\n</response>"])
+    assert parser.response_type == "response"
+    assert parser.complete
+    assert [event.kind for event in events] == ["open", "body", "close"]
+    assert body_text(events) == "Hello **world**\n"
+
+
+def test_single_chunk_script():
+    parser, events = feed_all([SCRIPT])
+    assert parser.response_type == "python-script"
+    assert parser.complete
+    assert [event.text for event in events if event.kind == "name"] == ["demo.py"]
+
+
+def test_tags_split_across_chunks():
+    chunks = [SCRIPT[i : i + 3] for i in range(0, len(SCRIPT), 3)]
+    parser, events = feed_all(chunks)
+    assert parser.response_type == "python-script"
+    assert parser.complete
+    assert body_text(events).strip() == "print('<response>hi</response> <cli>ls</cli>')"
+
+
+def test_tag_like_text_inside_body():
+    text = "<cli>echo '<response>' '</python-script>'</cli>"
+    parser, events = feed_all([text])
+    assert parser.response_type == "cli"
+    assert body_text(events) == "echo '<response>' '</python-script>'"
+    assert parse_model_response(text).response_type == "cli"
+
+
+def test_script_body_with_envelope_tags_parses_as_script():
+    parsed = parse_model_response(SCRIPT)
+    assert parsed.response_type == "python-script"
+    assert parsed.script_name == "demo.py"
+
+
+def test_script_cut_off_after_body_is_incomplete():
+    parser, events = feed_all([SCRIPT[: SCRIPT.index("</python-script>")]])
+    assert parser.response_type == "python-script"
+    assert not parser.complete
+    assert "close" not in [event.kind for event in events]